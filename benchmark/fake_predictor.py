@@ -0,0 +1,52 @@
+#!/usr/bin/env python
+"""
+Stand-in for an external MHC binding predictor (netMHC-like) with configurable latency. Reads one peptide
+per line and writes deterministic pseudo scores, so runs on the same input are comparable across versions.
+"""
+
+import os
+import sys
+import time
+import zlib
+import argparse
+
+
+def pseudo_score(peptide, allele):
+    # deterministic, roughly uniform in [0, 1)
+    return (zlib.crc32((peptide + allele).encode('ascii')) & 0xffffffff) / float(2 ** 32)
+
+
+def __main__():
+    parser = argparse.ArgumentParser(description="Fake external MHC binding predictor for benchmarks.")
+    parser.add_argument('-p', "--peptides", help="File with one peptide per line")
+    parser.add_argument('-a', "--alleles", help="Comma separated list of alleles")
+    parser.add_argument('-o', "--output", help="Output file, stdout if not specified")
+    # defaults can be set in the environment, the predictor is started by epaa.py without extra options
+    parser.add_argument("--startup", type=float, default=float(os.environ.get('FAKE_PREDICTOR_STARTUP', 0.5)), help="Start-up latency in seconds (loading allele data)")
+    parser.add_argument("--per_peptide", type=float, default=float(os.environ.get('FAKE_PREDICTOR_PER_PEPTIDE', 0.0002)), help="Latency per peptide and allele in seconds")
+    parser.add_argument("--version", action='store_true', help="Print version and exit")
+    args = parser.parse_args()
+
+    if args.version:
+        sys.stdout.write('fake_predictor 1.0\n')
+        return
+    if args.peptides is None or args.alleles is None:
+        parser.error("Please specify peptides (--peptides) and alleles (--alleles).")
+
+    time.sleep(args.startup)
+    with open(args.peptides, 'r') as inp:
+        peptides = [l.strip() for l in inp if l.strip()]
+    alleles = args.alleles.split(',')
+    time.sleep(args.per_peptide * len(peptides) * len(alleles))
+
+    out = open(args.output, 'w') if args.output else sys.stdout
+    out.write('peptide\tallele\tscore\n')
+    for a in alleles:
+        for p in peptides:
+            out.write('%s\t%s\t%.4f\n' % (p, a, pseudo_score(p, a)))
+    if args.output:
+        out.close()
+
+
+if __name__ == "__main__":
+    __main__()
@@ -0,0 +1,168 @@
+#!/usr/bin/env python
+"""
+Generates synthetic inputs for benchmarking epaa.py: variants as VCF (SnpEff ANN annotation) and GSvar,
+a peptide list, an allele file, a reference proteome and the transcript fixture used by the local
+BioMart stand-in in run_benchmark.py.
+"""
+
+import os
+import random
+import argparse
+
+BASES = 'ACGT'
+CODON_TABLE = {
+    'TTT': 'F', 'TTC': 'F', 'TTA': 'L', 'TTG': 'L', 'CTT': 'L', 'CTC': 'L', 'CTA': 'L', 'CTG': 'L',
+    'ATT': 'I', 'ATC': 'I', 'ATA': 'I', 'ATG': 'M', 'GTT': 'V', 'GTC': 'V', 'GTA': 'V', 'GTG': 'V',
+    'TCT': 'S', 'TCC': 'S', 'TCA': 'S', 'TCG': 'S', 'CCT': 'P', 'CCC': 'P', 'CCA': 'P', 'CCG': 'P',
+    'ACT': 'T', 'ACC': 'T', 'ACA': 'T', 'ACG': 'T', 'GCT': 'A', 'GCC': 'A', 'GCA': 'A', 'GCG': 'A',
+    'TAT': 'Y', 'TAC': 'Y', 'TAA': '*', 'TAG': '*', 'CAT': 'H', 'CAC': 'H', 'CAA': 'Q', 'CAG': 'Q',
+    'AAT': 'N', 'AAC': 'N', 'AAA': 'K', 'AAG': 'K', 'GAT': 'D', 'GAC': 'D', 'GAA': 'E', 'GAG': 'E',
+    'TGT': 'C', 'TGC': 'C', 'TGA': '*', 'TGG': 'W', 'CGT': 'R', 'CGC': 'R', 'CGA': 'R', 'CGG': 'R',
+    'AGT': 'S', 'AGC': 'S', 'AGA': 'R', 'AGG': 'R', 'GGT': 'G', 'GGC': 'G', 'GGA': 'G', 'GGG': 'G'
+}
+THREE_LETTER = {
+    'A': 'Ala', 'R': 'Arg', 'N': 'Asn', 'D': 'Asp', 'C': 'Cys', 'Q': 'Gln', 'E': 'Glu', 'G': 'Gly', 'H': 'His', 'I': 'Ile',
+    'L': 'Leu', 'K': 'Lys', 'M': 'Met', 'F': 'Phe', 'P': 'Pro', 'S': 'Ser', 'T': 'Thr', 'W': 'Trp', 'Y': 'Tyr', 'V': 'Val', '*': 'Ter'
+}
+SENSE_CODONS = sorted([c for c, aa in CODON_TABLE.items() if aa != '*'])
+ALLELES = ['HLA-A*01:01', 'HLA-A*02:01', 'HLA-B*07:02', 'HLA-B*08:01', 'HLA-C*03:03', 'HLA-C*07:02']
+AMINO_ACIDS = 'ACDEFGHIKLMNPQRSTVWY'
+
+
+def translate(seq):
+    return ''.join([CODON_TABLE[seq[i:i + 3]] for i in range(0, len(seq) - 2, 3)])
+
+
+def generate_transcripts(rnd, n_transcripts, min_codons, max_codons):
+    transcripts = []
+    for i in range(n_transcripts):
+        codons = ['ATG'] + [rnd.choice(SENSE_CODONS) for _ in range(rnd.randint(min_codons, max_codons))] + ['TAA']
+        transcripts.append({'transcript': 'ENST%011d' % (i + 1), 'protein': 'ENSP%011d' % (i + 1), 'swissprot': 'P%05d' % (i + 1),
+                            'gene': 'ENSG%011d' % (i // 2 + 1), 'symbol': 'GENE%d' % (i // 2 + 1), 'strand': '+',
+                            'chrom': str(rnd.randint(1, 22)), 'start': rnd.randint(10000, 200000000), 'sequence': ''.join(codons)})
+    return transcripts
+
+
+def generate_snv(rnd, t):
+    seq = t['sequence']
+    while True:
+        # never touch start and stop codon
+        cds_pos = rnd.randint(3, len(seq) - 4)
+        ref = seq[cds_pos]
+        alt = rnd.choice([b for b in BASES if b != ref])
+        codon_start = cds_pos - cds_pos % 3
+        codon = seq[codon_start:codon_start + 3]
+        mut_codon = codon[:cds_pos % 3] + alt + codon[cds_pos % 3 + 1:]
+        ref_aa, alt_aa = CODON_TABLE[codon], CODON_TABLE[mut_codon]
+        if ref_aa != alt_aa and alt_aa != '*':
+            break
+    prot_pos = codon_start // 3 + 1
+    return {'cds_pos': cds_pos, 'ref': ref, 'alt': alt, 'type': 'missense_variant',
+            'c': 'c.%d%s>%s' % (cds_pos + 1, ref, alt), 'p': 'p.%s%d%s' % (THREE_LETTER[ref_aa], prot_pos, THREE_LETTER[alt_aa])}
+
+
+def generate_frameshift(rnd, t):
+    seq = t['sequence']
+    cds_pos = rnd.randint(3, len(seq) - 4)
+    ref_aa = CODON_TABLE[seq[cds_pos - cds_pos % 3:cds_pos - cds_pos % 3 + 3]]
+    prot_pos = cds_pos // 3 + 1
+    return {'cds_pos': cds_pos, 'ref': seq[cds_pos - 1:cds_pos + 1], 'alt': seq[cds_pos - 1], 'type': 'frameshift_variant',
+            'c': 'c.%ddel%s' % (cds_pos + 1, seq[cds_pos]), 'p': 'p.%s%dfs' % (THREE_LETTER[ref_aa], prot_pos)}
+
+
+def generate_variants(rnd, transcripts, n_variants, frameshift_fraction):
+    variants = []
+    for i in range(n_variants):
+        t = rnd.choice(transcripts)
+        if rnd.random() < frameshift_fraction:
+            v = generate_frameshift(rnd, t)
+        else:
+            v = generate_snv(rnd, t)
+        v['transcript'] = t
+        # deletions are anchored at the preceding base
+        v['pos'] = t['start'] + v['cds_pos'] - len(v['ref']) + 1
+        variants.append(v)
+    variants.sort(key=lambda x: (int(x['transcript']['chrom']), x['pos']))
+    return variants
+
+
+def write_vcf(variants, filename):
+    with open(filename, 'w') as out:
+        out.write('##fileformat=VCFv4.1\n')
+        out.write('##INFO=<ID=ANN,Number=.,Type=String,Description="Functional annotations: \'Allele | Annotation | Annotation_Impact | Gene_Name | Gene_ID | Feature_Type | Feature_ID | Transcript_BioType | Rank | HGVS.c | HGVS.p | cDNA.pos / cDNA.length | CDS.pos / CDS.length | AA.pos / AA.length | Distance | ERRORS / WARNINGS / INFO\'">\n')
+        out.write('##INFO=<ID=HOM,Number=1,Type=Integer,Description="Homozygous variant">\n')
+        out.write('#CHROM\tPOS\tID\tREF\tALT\tQUAL\tFILTER\tINFO\n')
+        for i, v in enumerate(variants):
+            t = v['transcript']
+            ann = '|'.join([v['alt'], v['type'], 'MODERATE', t['symbol'], t['gene'], 'transcript', t['transcript'], 'protein_coding',
+                            '1/1', v['c'], v['p'], '', '', '', '', ''])
+            out.write('chr%s\t%d\t.\t%s\t%s\t60\tPASS\tANN=%s;HOM=0\n' % (t['chrom'], v['pos'], v['ref'], v['alt'], ann))
+
+
+def write_gsvar(variants, filename):
+    columns = ['#chr', 'start', 'end', 'ref', 'obs', 'tumor_af', 'tumor_dp', 'normal_af', 'normal_dp', 'rna_tum_freq', 'rna_tum_depth',
+               'gene', 'variant_type', 'coding_and_splicing']
+    with open(filename, 'w') as out:
+        out.write('##GSvar synthetic benchmark input\n')
+        out.write('\t'.join(columns) + '\n')
+        for v in variants:
+            t = v['transcript']
+            ref, obs, start = v['ref'], v['alt'], v['pos']
+            if v['type'] == 'frameshift_variant':
+                ref, obs, start = ref[1:], '-', start + 1
+            annotation = '%s:%s:%s:MODERATE:exon1/1:%s:%s' % (t['symbol'], t['transcript'], v['type'], v['c'], v['p'])
+            out.write('\t'.join(['chr' + t['chrom'], str(start), str(start + len(ref) - 1), ref, obs, '0.35', '80', '0.0', '60',
+                                 '0.3', '40', t['symbol'], v['type'], annotation]) + '\n')
+
+
+def write_peptides(rnd, n_peptides, min_length, max_length, filename):
+    with open(filename, 'w') as out:
+        out.write('id\tsequence\tsample\tscore\n')
+        for i in range(n_peptides):
+            seq = ''.join([rnd.choice(AMINO_ACIDS) for _ in range(rnd.randint(min_length, max_length))])
+            out.write('pep%d\t%s\tsynthetic\t%.3f\n' % (i, seq, rnd.random()))
+
+
+def write_fixture(transcripts, filename):
+    with open(filename, 'w') as out:
+        out.write('transcript\tprotein\tswissprot\tgene\tsymbol\tstrand\tsequence\n')
+        for t in transcripts:
+            out.write('\t'.join([t[k] for k in ['transcript', 'protein', 'swissprot', 'gene', 'symbol', 'strand', 'sequence']]) + '\n')
+
+
+def write_proteome(transcripts, filename):
+    with open(filename, 'w') as out:
+        for t in transcripts:
+            out.write('>sp|%s|%s_HUMAN\n%s\n' % (t['swissprot'], t['symbol'], translate(t['sequence']).rstrip('*')))
+
+
+def __main__():
+    parser = argparse.ArgumentParser(description="Generates synthetic inputs for epaa.py benchmarks.")
+    parser.add_argument('-v', "--variants", type=int, default=1000, help="Number of variants")
+    parser.add_argument('-t', "--transcripts", type=int, default=500, help="Number of transcripts carrying variants")
+    parser.add_argument('-p', "--peptides", type=int, default=10000, help="Number of peptides in peptide input")
+    parser.add_argument("--frameshift_fraction", type=float, default=0.05, help="Fraction of frameshift variants")
+    parser.add_argument("--min_codons", type=int, default=150, help="Minimum number of codons per transcript")
+    parser.add_argument("--max_codons", type=int, default=900, help="Maximum number of codons per transcript")
+    parser.add_argument("--seed", type=int, default=42, help="Random seed")
+    parser.add_argument('-o', "--output_dir", default='.', help="All files written will be put in this directory")
+    args = parser.parse_args()
+
+    rnd = random.Random(args.seed)
+    if not os.path.isdir(args.output_dir):
+        os.makedirs(args.output_dir)
+
+    transcripts = generate_transcripts(rnd, args.transcripts, args.min_codons, args.max_codons)
+    variants = generate_variants(rnd, transcripts, args.variants, args.frameshift_fraction)
+
+    write_fixture(transcripts, os.path.join(args.output_dir, 'transcripts.tsv'))
+    write_proteome(transcripts, os.path.join(args.output_dir, 'proteome.fasta'))
+    write_vcf(variants, os.path.join(args.output_dir, 'synthetic.vcf'))
+    write_gsvar(variants, os.path.join(args.output_dir, 'synthetic.GSvar'))
+    write_peptides(rnd, args.peptides, 8, 11, os.path.join(args.output_dir, 'synthetic_peptides.tsv'))
+    with open(os.path.join(args.output_dir, 'alleles.txt'), 'w') as out:
+        out.write('\n'.join(ALLELES) + '\n')
+
+
+if __name__ == "__main__":
+    __main__()
@@ -0,0 +1,260 @@
+#!/usr/bin/env python
+"""
+Times the stages of epaa.py on synthetic inputs (see generate_inputs.py) without network access or licensed
+predictors: BioMart and the MartsAdapter are replaced by a fixture-backed stand-in, external predictors by
+fake_predictor.py (registered as external method 'fakemhc-1.0', so it runs through the chunked runner of epaa.py).
+All other stages are the code paths of epaa.py. Results are appended as one JSON document per run to the output file.
+"""
+
+import os
+import sys
+import json
+import time
+import shutil
+import logging
+import argparse
+import platform
+import tempfile
+import subprocess
+
+from contextlib import contextmanager
+
+BENCHMARK_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(BENCHMARK_DIR, '..', 'bin'))
+
+import epaa
+
+from Fred2.EpitopePrediction.External import AExternalEpitopePrediction
+from Fred2.Core.Allele import Allele
+from Fred2.IO import FileReader
+from Fred2.IO.ADBAdapter import ADBAdapter, EAdapterFields, EIdentifierTypes
+
+FAKE_PREDICTOR = os.path.join(BENCHMARK_DIR, 'fake_predictor.py')
+
+
+class LocalMartsAdapter(ADBAdapter):
+    """
+    fixture-backed stand-in for the Fred2 MartsAdapter and the BioMart protein id lookup of epaa.py
+    """
+
+    def __init__(self, fixture):
+        self.transcripts = {}
+        with open(fixture, 'r') as inp:
+            header = inp.readline().strip().split('\t')
+            for l in inp:
+                row = dict(zip(header, l.rstrip('\n').split('\t')))
+                self.transcripts[row['transcript']] = row
+
+    def get_transcript_information(self, transcript_id, type=EIdentifierTypes.ENSEMBL, **kwargs):
+        if transcript_id not in self.transcripts:
+            return None
+        t = self.transcripts[transcript_id]
+        return {EAdapterFields.SEQ: t['sequence'], EAdapterFields.GENE: t['gene'], EAdapterFields.STRAND: t['strand']}
+
+    def get_transcript_sequence(self, transcript_id, type=EIdentifierTypes.ENSEMBL, **kwargs):
+        return self.transcripts[transcript_id]['sequence'] if transcript_id in self.transcripts else None
+
+    def get_product_sequence(self, product_id, **kwargs):
+        return None
+
+    def get_protein_ids_for_transcripts(self, idtype, transcripts, ensembl_url, reference):
+        result = {}
+        result_swissProt = {}
+        for t in transcripts:
+            if t in self.transcripts:
+                result[t] = [self.transcripts[t]['protein']]
+                result_swissProt[t] = [self.transcripts[t]['swissprot']]
+        return result, result_swissProt
+
+
+class _AnyAllele(object):
+    def __contains__(self, item):
+        return True
+
+
+class FakeExternalPredictor(AExternalEpitopePrediction):
+    """
+    Fred2 wrapper for fake_predictor.py, registered as 'fakemhc' version '1.0'
+    """
+    __alleles = _AnyAllele()
+    __supported_length = frozenset(range(8, 26))
+    __name = "fakemhc"
+    __command = FAKE_PREDICTOR + " -p %s -a %s %s -o %s"
+    __version = "1.0"
+
+    @property
+    def version(self):
+        return self.__version
+
+    @property
+    def name(self):
+        return self.__name
+
+    @property
+    def command(self):
+        return self.__command
+
+    @property
+    def supportedAlleles(self):
+        return self.__alleles
+
+    @property
+    def supportedLength(self):
+        return self.__supported_length
+
+    def convert_alleles(self, alleles):
+        return ["HLA-%s%s:%s" % (a.locus, a.supertype, a.subtype) for a in alleles]
+
+    def parse_external_result(self, file):
+        result = {}
+        with open(file, 'r') as inp:
+            inp.readline()
+            for l in inp:
+                peptide, allele, score = l.strip().split('\t')
+                result.setdefault(allele, {})[peptide] = float(score)
+        return result
+
+    def get_external_version(self, path=None):
+        # must match self.version, the output is 'fake_predictor 1.0'
+        return subprocess.check_output([FAKE_PREDICTOR, '--version']).strip().split()[-1]
+
+    def prepare_input(self, _input, _file):
+        _file.write("\n".join(_input))
+
+
+class StageTimer(object):
+
+    def __init__(self):
+        self.stages = {}
+        self.substages = {}
+
+    @contextmanager
+    def stage(self, name):
+        start = time.time()
+        yield
+        self.stages[name] = self.stages.get(name, 0.0) + time.time() - start
+
+    def wrap(self, obj, function, name):
+        """
+        times all calls of obj.function (module function or method of an instance) within a stage as sub-stage name
+        """
+        original = getattr(obj, function)
+
+        def timed(*args, **kwargs):
+            start = time.time()
+            try:
+                return original(*args, **kwargs)
+            finally:
+                self.substages[name] = self.substages.get(name, 0.0) + time.time() - start
+        setattr(obj, function, timed)
+
+    def report(self, times):
+        # times of many short calls are summed unrounded
+        return dict((k, round(v, 4)) for k, v in times.iteritems())
+
+
+def get_git_revision():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'], cwd=BENCHMARK_DIR).strip().decode('ascii')
+    except (OSError, subprocess.CalledProcessError):
+        return 'unknown'
+
+
+def benchmark_variants(args, timer, methods, alleles, minlength, maxlength, mart, protein_db):
+    counts = {}
+    with timer.stage('read_vcf'):
+        vl_vcf, transcripts_vcf = epaa.read_vcf(os.path.join(args.input_dir, 'synthetic.vcf'))
+    with timer.stage('read_GSvar'):
+        vl, transcripts, metadata = epaa.read_GSvar(os.path.join(args.input_dir, 'synthetic.GSvar'))
+    counts['variants'] = len(vl)
+
+    with timer.stage('protein_id_lookup'):
+        epaa.transcriptProteinMap, epaa.transcriptSwissProtMap = epaa.get_protein_ids_for_transcripts(epaa.ID_SYSTEM_USED, list(set(transcripts)), None, 'GRCh37')
+
+    with timer.stage('variant_prediction'):
+        pred_dataframes, statistics = epaa.make_predictions_from_variants(vl, methods, alleles, minlength, maxlength, mart, protein_db, 'benchmark',
+                                                                          metadata, epaa.transcriptProteinMap)
+    counts['peptides'] = statistics['peptides']
+    counts['filtered_peptides'] = statistics['filter']
+
+    with timer.stage('output'):
+        if pred_dataframes:
+            complete_df = epaa.pd.concat(pred_dataframes)
+            complete_df.to_csv(os.path.join(args.work_dir, 'variants_prediction_results.tsv'), sep='\t', index=False)
+            counts['predictions'] = complete_df.shape[0]
+    return counts
+
+
+def benchmark_peptides(args, timer, methods, alleles, protein_db):
+    counts = {}
+    with timer.stage('read_peptide_input'):
+        peptides, metadata = epaa.read_peptide_input(os.path.join(args.input_dir, 'synthetic_peptides.tsv'))
+    counts['peptides'] = len(peptides)
+    with timer.stage('peptide_prediction'):
+        pred_dataframes, statistics = epaa.make_predictions_from_peptides(peptides, methods, alleles, protein_db, 'benchmark', metadata)
+    with timer.stage('peptide_output'):
+        if pred_dataframes:
+            complete_df = epaa.pd.concat(pred_dataframes)
+            complete_df.to_csv(os.path.join(args.work_dir, 'peptides_prediction_results.tsv'), sep='\t', index=False)
+            counts['predictions'] = complete_df.shape[0]
+    return counts
+
+
+def __main__():
+    parser = argparse.ArgumentParser(description="Benchmarks the stages of epaa.py on synthetic inputs.")
+    parser.add_argument('-i', "--input_dir", required=True, help="Directory with inputs created by generate_inputs.py")
+    parser.add_argument('-c', "--mhcclass", default="I", help="MHC class I or II")
+    parser.add_argument("--startup", type=float, default=0.5, help="Start-up latency of the fake predictor in seconds")
+    parser.add_argument("--per_peptide", type=float, default=0.0002, help="Latency of the fake predictor per peptide and allele in seconds")
+    parser.add_argument('-t', "--threads", type=int, default=1, help="Number of concurrent external predictor processes")
+    parser.add_argument("--skip_peptides", action='store_true', help="Do not benchmark the peptide input mode")
+    parser.add_argument('-o', "--output", default='benchmark_results.jsonl', help="File the results are appended to (one JSON document per run)")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.WARNING)
+    args.work_dir = tempfile.mkdtemp(prefix='epaa_benchmark_')
+
+    timer = StageTimer()
+    mart = LocalMartsAdapter(os.path.join(args.input_dir, 'transcripts.tsv'))
+    epaa.get_protein_ids_for_transcripts = mart.get_protein_ids_for_transcripts
+
+    # the fake predictor is run by the external runner of epaa.py, its latency is passed via the environment
+    epaa.EXTERNAL_METHODS['fakemhc-1.0'] = 5000
+    epaa.MIXED_LENGTH_METHODS.add('fakemhc-1.0')
+    epaa.EXTERNAL_RUNNER['threads'] = args.threads
+    os.environ['FAKE_PREDICTOR_STARTUP'] = str(args.startup)
+    os.environ['FAKE_PREDICTOR_PER_PEPTIDE'] = str(args.per_peptide)
+
+    # time spent in peptide generation, predictors and annotation of the variant predictions, part of the prediction stages
+    timer.wrap(epaa.generator, 'generate_peptides_from_proteins', 'peptide_generation')
+    timer.wrap(epaa, 'predict_peptides', 'predictor_calls')
+    timer.wrap(epaa, 'annotate_variant_predictions', 'annotation')
+
+    alleles = FileReader.read_lines(os.path.join(args.input_dir, 'alleles.txt'), in_type=Allele)
+    methods = ['fakemhc-1.0', 'syfpeithi-1.0']
+    minlength, maxlength = (8, 12) if args.mhcclass == 'I' else (15, 17)
+
+    with timer.stage('read_reference_proteome'):
+        protein_db = epaa.load_reference_proteome(os.path.join(args.input_dir, 'proteome.fasta'), args.threads)
+    # self-filter lookups of all peptides
+    timer.wrap(protein_db, 'exists', 'self_filter')
+
+    try:
+        counts = {'variant_mode': benchmark_variants(args, timer, methods, alleles, minlength, maxlength, mart, protein_db)}
+        if not args.skip_peptides:
+            counts['peptide_mode'] = benchmark_peptides(args, timer, methods, alleles, protein_db)
+    finally:
+        shutil.rmtree(args.work_dir)
+
+    result = {'epaa_version': epaa.VERSION, 'git_revision': get_git_revision(), 'date': epaa.datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
+              'python': platform.python_version(), 'host': platform.node(), 'mhcclass': args.mhcclass, 'alleles': len(alleles),
+              'predictor_latency': {'startup': args.startup, 'per_peptide': args.per_peptide},
+              'counts': counts, 'stages': timer.report(timer.stages), 'substages': timer.report(timer.substages), 'total': round(sum(timer.stages.values()), 4)}
+
+    with open(args.output, 'a') as out:
+        out.write(json.dumps(result, sort_keys=True) + '\n')
+    sys.stdout.write(json.dumps(result, sort_keys=True, indent=2) + '\n')
+
+
+if __name__ == "__main__":
+    __main__()
@@ -9,21 +9,35 @@ import vcf
 import argparse
 import urllib2
 import itertools
+import copy
 import pandas as pd
 import numpy as np
 import Fred2.Core.Generator as generator
 import math
-
-from collections import defaultdict
+import time
+import mmap
+import signal
+import hashlib
+import multiprocessing
+import json
+import heapq
+import tempfile
+import subprocess
+
+from collections import defaultdict, Counter, namedtuple
+from contextlib import contextmanager
+from pandas.api.types import union_categoricals
 from Fred2.IO.MartsAdapter import MartsAdapter
 from Fred2.Core.Variant import Variant, VariationType, MutationSyntax
 from Fred2.EpitopePrediction import EpitopePredictorFactory
+from Fred2.Core.Result import EpitopePredictionResult
 from Fred2.IO.ADBAdapter import EIdentifierTypes
 from Fred2.IO.UniProtAdapter import UniProtDB
 from Fred2.Core.Allele import Allele
 from Fred2.Core.Peptide import Peptide
 from Fred2.IO import FileReader
 from Bio import SeqUtils
+from Bio.Seq import translate
 from datetime import datetime
 from string import Template
 
@@ -34,6 +48,35 @@ ID_SYSTEM_USED = EIdentifierTypes.ENSEMBL
 transcriptProteinMap = {}
 transcriptSwissProtMap = {}
 
+# Ensembl archives (BioMart) per reference genome
+REFERENCES = {'GRCh37': 'http://feb2014.archive.ensembl.org', 'GRCh38': 'http://dec2016.archive.ensembl.org'}
+
+# external predictor binaries run in chunks by run_external_predictor, with maximal chunk size per method
+EXTERNAL_METHODS = {'netmhc-4.0': 5000, 'netmhcpan-3.0': 2000, 'netmhcII-2.2': 2000, 'netmhcIIpan-3.1': 1000}
+EXTERNAL_RUNNER = {'threads': 1, 'timeout': 1800, 'retries': 1}
+# external predictor binaries reading peptides of any length from one input file (-p), a chunk of mixed lengths is run
+# with one command. Fred2 starts the other binaries once per peptide length
+MIXED_LENGTH_METHODS = set(['netmhc-4.0', 'netmhcpan-3.0'])
+
+# cascade mode, only peptides scoring above a per allele and length cutoff with the prefilter method are sent to the other
+# methods. Cutoffs are configured (fraction of the max matrix score per allele and length, see read_cascade_thresholds) or
+# calibrated on a sample of the peptides to keep the given recall of binders, 'threshold' is used if a sample has no binders
+CASCADE = {'enabled': False, 'prefilter': 'syfpeithi-1.0', 'threshold': 0.25, 'thresholds': {}, 'recall': 0.99, 'calibration_size': 500, 'cutoffs': {}}
+
+# output filter of variant based predictions: 'all' rows, rows passing the affinity/Syfpeithi 'threshold', or the 'topk'
+# rows per variant, allele or sample (and method), applied before the rows are annotated
+OUTPUT_FILTER = {'mode': 'all', 'affinity_threshold': 500.0, 'syfpeithi_threshold': 50.0, 'k': 10, 'by': 'allele'}
+
+# percentile ranks of predictions against cached background score distributions (BackgroundScores), None disables the %rank columns
+PERCENTILE_RANK = {'background': None}
+
+# peptide chunk size of variant based predictions, set by the resource planner (None predicts all peptides at once)
+RESOURCE_PLAN = {'chunk_size': None}
+
+# rough cost model of a prediction run, memory in MB and runtime in seconds
+COST_MODEL = {'base_memory': 500, 'protein_memory': 0.05, 'peptide_memory': 0.002, 'prediction_memory': 0.001, 'annotation_copies': 4,
+              'worker_memory': 250, 'peptide_runtime': 0.0005, 'prediction_runtime': 0.0002, 'startup_runtime': 5}
+
 
 REPORT_TEMPLATE = """
 ###################################################################
@@ -78,14 +121,26 @@ When personalized protein sequences are provided, peptides will be filtered agai
 Stats
 -------------
 Number of Variants: $variants
+Number of Variants Pruned by Allele Frequency/Read Depth: $pruned_frequency
+Number of Variants Pruned by Gene Expression: $pruned_expression
 Number of Peptides: $peptides
 Number of Peptides after Filtering: $filter
 Number of Predictions: $predictions
+Number of Predictions Skipped by Cascade Prefilter: $skipped
+Number of Predictions Dropped by Output Filter: $dropped
 Number of Predicted Binders: $binders
 Number of Predicted Non-Binders: $nonbinders
 Number of Binding Peptides: $uniquebinders
 Number of Non-Binding Peptides: $uniquenonbinders
 
+Predicted Binders per Allele
+-------------
+$allelebinders
+
+Predicted Binders per Method
+-------------
+$methodbinders
+
 Contacts
 -------------
 mohr@informatik.uni-tuebingen.de
@@ -134,11 +189,12 @@ def check_min_req_GSvar(row):
     return False
 
 
-def read_GSvar(filename, pass_only=True):
+def read_GSvar(filename, pass_only=True, limit_combinations=True):
     """
     reads GSvar and tsv files (tab sep files in context of genetic variants), omitting and warning about rows missing
     mandatory columns
     :param filename: /path/to/file
+    :param limit_combinations: treat variants of transcripts with many variants as homozygous (limit_variant_combinations)
     :return: list FRED2 variants
     """
     global ID_SYSTEM_USED
@@ -146,13 +202,10 @@ def read_GSvar(filename, pass_only=True):
 
     metadata_list = ["vardbid", "normal_dp", "tumor_dp", "tumor_af", "normal_af", "rna_tum_freq", "rna_tum_depth"]
 
-    list_vars = list()
     lines = list()
     transcript_ids = []
     dict_vars = {}
 
-    cases = 0
-
     with open(filename, 'rb') as tsvfile:
         tsvreader = csv.DictReader((row for row in tsvfile if not row.startswith('##')), delimiter='\t')
         for row in tsvreader:
@@ -233,32 +286,18 @@ def read_GSvar(filename, pass_only=True):
             var.log_metadata("rna_tum_freq", rna_tum_freq)
             var.log_metadata("rna_tum_depth", rna_tum_dp)
             dict_vars[var] = var
-            list_vars.append(var)
-
-    transToVar = {}
-
-    # fix because of memory/timing issues due to combinatoric explosion
-    for v in list_vars:
-        for trans_id in v.coding.iterkeys():
-            transToVar.setdefault(trans_id, []).append(v)
 
-    for tId, vs in transToVar.iteritems():
-        if len(vs) > 10:
-            cases += 1
-            for v in vs:
-                vs_new = Variant(v.id, v.type, v.chrom, v.genomePos, v.ref, v.obs, v.coding, True, v.isSynonymous)
-                vs_new.gene = v.gene
-                for m in metadata_list:
-                    vs_new.log_metadata(m, v.get_metadata(m)[0])
-                dict_vars[v] = vs_new
+    if limit_combinations:
+        return limit_variant_combinations(dict_vars.values(), metadata_list), transcript_ids, metadata_list
     return dict_vars.values(), transcript_ids, metadata_list
 
 
-def read_vcf(filename, pass_only=True):
+def read_vcf(filename, pass_only=True, limit_combinations=True):
     """
     reads vcf files
     returns a list of FRED2 variants
     :param filename: /path/to/file
+    :param limit_combinations: treat variants of transcripts with many variants as homozygous (limit_variant_combinations)
     :return: list of FRED2 variants
     """
     global ID_SYSTEM_USED
@@ -269,7 +308,6 @@ def read_vcf(filename, pass_only=True):
         vl = [r for r in vcf_reader]
 
     dict_vars = {}
-    list_vars = []
     transcript_ids = []
     genotye_dict = {"het": False, "hom": True, "ref": True}
 
@@ -365,25 +403,224 @@ def read_vcf(filename, pass_only=True):
                     var.gene = gene
                     var.log_metadata("vardbid", variation_dbid)
                     dict_vars[var] = var
-                    list_vars.append(var)
 
-    transToVar = {}
+    if limit_combinations:
+        return limit_variant_combinations(dict_vars.values(), ["vardbid"]), transcript_ids
+    return dict_vars.values(), transcript_ids
 
-    # fix because of memory/timing issues due to combinatoric explosion
-    for v in list_vars:
+
+# transcripts with more variants are not combined, their variants are treated as homozygous
+MAX_COMBINED_VARIANTS = 10
+
+
+def limit_variant_combinations(variants, metadata):
+    """
+    fix because of memory/timing issues due to combinatoric explosion: FRED2 generates all combinations of the
+    heterozygous variants of a transcript, variants of transcripts with more than MAX_COMBINED_VARIANTS variants
+    are marked homozygous. Applied per sample after reading, variant shards keep the zygosity of the input
+    :param variants: list of FRED2 variants
+    :param metadata: list of metadata labels copied to the new variants
+    :return: list of FRED2 variants
+    """
+    transToVar = {}
+    for v in variants:
         for trans_id in v.coding.iterkeys():
             transToVar.setdefault(trans_id, []).append(v)
 
+    replaced = {}
     for tId, vs in transToVar.iteritems():
-        if len(vs) > 10:
+        if len(vs) > MAX_COMBINED_VARIANTS:
             for v in vs:
                 vs_new = Variant(v.id, v.type, v.chrom, v.genomePos, v.ref, v.obs, v.coding, True, v.isSynonymous)
                 vs_new.gene = v.gene
-                for m in ["vardbid"]:
-                    vs_new.log_metadata(m, v.get_metadata(m))
-                dict_vars[v] = vs_new
+                for m in metadata:
+                    logged = v.get_metadata(m)
+                    vs_new.log_metadata(m, logged[0] if logged else None)
+                replaced[v] = vs_new
+    return [replaced.get(v, v) for v in variants]
 
-    return dict_vars.values(), transcript_ids
+
+def estimate_transcript_peptides(variants, minlength, maxlength):
+    """
+    estimates the number of peptides generated per transcript: windows of all lengths around each variant for
+    every combination of its heterozygous variants (see limit_variant_combinations)
+    :return: dictionary transcript id: estimated number of peptides
+    """
+    transToVar = {}
+    for v in variants:
+        for trans_id in v.coding.iterkeys():
+            transToVar.setdefault(trans_id, []).append(v)
+
+    estimates = {}
+    for tId, vs in transToVar.iteritems():
+        heterozygous = 0 if len(vs) > MAX_COMBINED_VARIANTS else len([v for v in vs if not v.isHomozygous])
+        estimates[tId] = estimate_variant_peptides(len(vs), minlength, maxlength) * 2 ** heterozygous
+    return estimates
+
+
+# binary variant shards written by 'epaa.py parse': magic, header length, JSON header with the section offsets,
+# then the sections (8 byte aligned). Strings are stored once in a blob and referenced by index, -1 is None.
+SHARD_MAGIC = b'EPAAVAR1'
+SHARD_VARIANT_DTYPE = np.dtype([('id', '<i4'), ('type', '<i1'), ('homozygous', '?'), ('synonymous', '?'), ('chrom', '<i4'), ('pos', '<i8'),
+                                ('ref', '<i4'), ('obs', '<i4'), ('gene', '<i4'), ('coding_start', '<i4'), ('coding_count', '<i4')])
+SHARD_CODING_DTYPE = np.dtype([('transcript', '<i4'), ('trans_pos', '<i4'), ('prot_pos', '<i4'), ('cds_syntax', '<i4'), ('prot_syntax', '<i4')])
+SHARD_VARIANT_TYPES = [VariationType.SNP, VariationType.DEL, VariationType.INS, VariationType.FSDEL, VariationType.FSINS, VariationType.UNKNOWN]
+
+
+class ShardStringTable(object):
+
+    def __init__(self):
+        self.index = {}
+        self.strings = []
+
+    def add(self, value):
+        if value is None:
+            return -1
+        value = str(value)
+        if value not in self.index:
+            self.index[value] = len(self.strings)
+            self.strings.append(value)
+        return self.index[value]
+
+
+def group_variants_by_transcript(variants, n_shards, minlength, maxlength):
+    """
+    groups variants into at most n_shards shards, variants sharing a transcript (directly or via other variants)
+    end up in the same shard so that their combinations are generated together. Shards are balanced by the
+    estimated number of peptides of their transcripts
+    :param minlength: minimal peptide length
+    :param maxlength: maximal peptide length (exclusive)
+    :return: list of lists of FRED2 variants
+    """
+    parent = {}
+
+    def find(x):
+        while parent.setdefault(x, x) != x:
+            parent[x] = parent[parent[x]]
+            x = parent[x]
+        return x
+
+    for v in variants:
+        transcripts = list(v.coding.iterkeys())
+        for t in transcripts[1:]:
+            parent[find(t)] = find(transcripts[0])
+
+    components = defaultdict(list)
+    for v in variants:
+        components[find(next(v.coding.iterkeys()))].append(v)
+
+    peptides = estimate_transcript_peptides(variants, minlength, maxlength)
+    weights = dict((root, sum([peptides[t] for t in set([t for v in group for t in v.coding])])) for root, group in components.iteritems())
+
+    # largest groups first into the currently smallest shard
+    shards = [[] for i in xrange(max(1, n_shards))]
+    sizes = [(0, i) for i in xrange(len(shards))]
+    for root in sorted(components, key=lambda r: -weights[r]):
+        size, i = heapq.heappop(sizes)
+        shards[i].extend(components[root])
+        heapq.heappush(sizes, (size + weights[root], i))
+    return [shard for shard in shards if shard]
+
+
+def write_variant_shard(variants, metadata, filename):
+    """
+    writes ready-to-use variant records (position, ref/alt, type, zygosity, per-transcript mutation syntax, metadata)
+    :param variants: list of FRED2 variants
+    :param metadata: list of metadata labels returned by the reader, 'vardbid' is always stored
+    :param filename: /path/to/shard.epv
+    """
+    labels = metadata + [m for m in ['vardbid'] if m not in metadata]
+    strings = ShardStringTable()
+    records = np.zeros(len(variants), dtype=SHARD_VARIANT_DTYPE)
+    coding = np.zeros(sum([len(v.coding) for v in variants]), dtype=SHARD_CODING_DTYPE)
+    values = np.full((len(variants), len(labels)), -1, dtype='<i4')
+
+    c = 0
+    for i, v in enumerate(variants):
+        records[i] = (strings.add(v.id), SHARD_VARIANT_TYPES.index(v.type), v.isHomozygous, v.isSynonymous, strings.add(v.chrom), v.genomePos,
+                      strings.add(v.ref), strings.add(v.obs), strings.add(getattr(v, 'gene', None)), c, len(v.coding))
+        for trans_id, syntax in sorted(v.coding.iteritems()):
+            coding[c] = (strings.add(trans_id), syntax.tranPos, syntax.protPos, strings.add(syntax.cdsMutationSyntax), strings.add(syntax.aaMutationSyntax))
+            c += 1
+        for j, m in enumerate(labels):
+            logged = v.get_metadata(m)
+            values[i, j] = strings.add(logged[0]) if logged else -1
+
+    blob = ''.join(strings.strings).encode('utf-8')
+    offsets = np.zeros(len(strings.strings) + 1, dtype='<i8')
+    offsets[1:] = np.cumsum([len(x.encode('utf-8')) for x in strings.strings])
+
+    sections = [('variants', records), ('coding', coding), ('metadata', values), ('string_offsets', offsets)]
+    header = {'version': 1, 'metadata': metadata, 'labels': labels, 'id_system': 'REFSEQ' if ID_SYSTEM_USED == EIdentifierTypes.REFSEQ else 'ENSEMBL',
+              'int_ids': all([isinstance(v.id, (int, long)) for v in variants]) if variants else False, 'sections': {}}
+    # offsets are relative to the end of the header
+    offset = 0
+    for name, arr in sections + [('strings', blob)]:
+        nbytes = len(arr) if name == 'strings' else arr.nbytes
+        header['sections'][name] = [offset, nbytes]
+        offset += nbytes + (-nbytes % 8)
+    header_bytes = json.dumps(header, sort_keys=True).encode('ascii')
+    header_bytes += b' ' * (-(len(SHARD_MAGIC) + 8 + len(header_bytes)) % 8)
+
+    # the prediction step must not see partial shards
+    with atomic_output(filename) as out:
+        out.write(SHARD_MAGIC)
+        out.write(np.array([len(header_bytes)], dtype='<i8').tobytes())
+        out.write(header_bytes)
+        for name, arr in sections + [('strings', blob)]:
+            data = arr if name == 'strings' else arr.tobytes()
+            out.write(data)
+            out.write(b'\0' * (-len(data) % 8))
+
+
+def read_variant_shard(filename):
+    """
+    loads a binary variant shard written by 'epaa.py parse' via mmap, no text parsing or annotation regexes
+    :param filename: /path/to/shard.epv
+    :return: list of FRED2 variants, list of transcript ids, list of metadata labels (like read_GSvar)
+    """
+    global ID_SYSTEM_USED
+
+    with open(filename, 'rb') as inp:
+        buf = mmap.mmap(inp.fileno(), 0, access=mmap.ACCESS_READ)
+    if buf[:len(SHARD_MAGIC)] != SHARD_MAGIC:
+        raise ValueError("{} is not a variant shard".format(filename))
+    header_length = int(np.frombuffer(buf, dtype='<i8', count=1, offset=len(SHARD_MAGIC))[0])
+    start = len(SHARD_MAGIC) + 8
+    header = json.loads(buf[start:start + header_length].decode('ascii'))
+    start += header_length
+    if header['id_system'] == 'REFSEQ':
+        ID_SYSTEM_USED = EIdentifierTypes.REFSEQ
+
+    def section(name, dtype):
+        offset, nbytes = header['sections'][name]
+        return np.frombuffer(buf, dtype=dtype, count=nbytes // np.dtype(dtype).itemsize, offset=start + offset)
+
+    records = section('variants', SHARD_VARIANT_DTYPE)
+    coding = section('coding', SHARD_CODING_DTYPE)
+    labels = header['labels']
+    values = section('metadata', '<i4').reshape((len(records), len(labels)))
+    offsets = section('string_offsets', '<i8')
+    blob_start = start + header['sections']['strings'][0]
+    strings = [buf[blob_start + offsets[i]:blob_start + offsets[i + 1]].decode('utf-8') for i in xrange(len(offsets) - 1)]
+    string = lambda i: strings[i] if i >= 0 else None
+
+    variants = []
+    transcript_ids = []
+    for i, r in enumerate(records):
+        syntaxes = {}
+        for c in coding[r['coding_start']:r['coding_start'] + r['coding_count']]:
+            trans_id = string(c['transcript'])
+            syntaxes[trans_id] = MutationSyntax(trans_id, int(c['trans_pos']), int(c['prot_pos']), string(c['cds_syntax']), string(c['prot_syntax']))
+            transcript_ids.append(trans_id)
+        var_id = int(string(r['id'])) if header['int_ids'] else string(r['id'])
+        var = Variant(var_id, SHARD_VARIANT_TYPES[r['type']], string(r['chrom']), int(r['pos']), string(r['ref']), string(r['obs']), syntaxes,
+                      bool(r['homozygous']), isSynonymous=bool(r['synonymous']))
+        var.gene = string(r['gene'])
+        for j, m in enumerate(labels):
+            var.log_metadata(m, string(values[i, j]))
+        variants.append(var)
+    return variants, transcript_ids, header['metadata']
 
 
 def read_peptide_input(filename):
@@ -406,6 +643,30 @@ def read_peptide_input(filename):
     return peptides, metadata
 
 
+def read_peptide_table(filename, chunksize=500000):
+    """
+    reads large peptide lists chunk-wise into a columnar table, metadata columns are stored as categoricals
+    :param filename: /path/to/file, expected columns (min required): id sequence
+    :return: dataframe with one row per input line, list of metadata columns
+    """
+    # metadata columns are converted per chunk, so that only one chunk is held as strings at a time
+    chunks = []
+    for chunk in pd.read_csv(filename, sep='\t', dtype=str, chunksize=chunksize):
+        for c in chunk.columns:
+            if c != 'sequence':
+                chunk[c] = chunk[c].astype('category')
+        chunks.append(chunk)
+    if not chunks:
+        return pd.DataFrame(columns=['sequence']), []
+
+    metadata = [c for c in chunks[0].columns if c != 'sequence']
+    columns = {'sequence': pd.concat([chunk['sequence'] for chunk in chunks], ignore_index=True)}
+    for c in metadata:
+        # categories of all chunks combined without converting back to strings
+        columns[c] = pd.Series(union_categoricals([chunk[c] for chunk in chunks]))
+    return pd.DataFrame(columns, columns=chunks[0].columns), metadata
+
+
 # parse protein_groups of MaxQuant output to get protein intensitiy values
 def read_protein_quant(filename):
     # protein id: sample1: intensity, sample2: instensity:
@@ -572,12 +833,15 @@ def create_metadata_column_value(pep, c):
         return ','.join(meta)
 
 
-def create_wt_seq_column_value(pep, wtseqs):
+def create_novel_column_value(pep):
+    # frameshift peptides without wild-type counterpart
+    return isinstance(pep[0], (NeoORFPeptide, StoredPeptide)) and pep[0].novel
+
+
+def create_wt_seq_column_value(pep, wt_reconstructor):
     transcripts = [x for x in set(pep[0].get_all_transcripts())]
-    variants = []
-    #for t in transcript_ids:
-    #    variants.extend([v for v in pep[0].get_variants_by_protein(t)])
-    wt = set([str(wtseqs['{}_{}'.format(str(pep[0]), t.transcript_id)]) for t in transcripts if bool(t.vars) and '{}_{}'.format(str(pep[0]), t.transcript_id) in wtseqs])
+    wt_seqs = [wt_reconstructor.get(pep[0], t.transcript_id) for t in transcripts if bool(t.vars)]
+    wt = set([str(w) for w in wt_seqs if w is not None])
     if len(wt) is 0:
         return np.nan
     else:
@@ -591,12 +855,120 @@ def create_quant_column_value(row, dict):
         value = np.nan
     return value
 
+
+class GeneIndex(object):
+    """
+    memory-mapped index of the coding gene list (Ensembl gene id, HGNC symbol, gene length), records are sorted
+    by Ensembl id, the symbol columns hold the symbols in sorted order and the record they belong to
+    """
+    DTYPE = np.dtype([('ensembl', 'S15'), ('symbol', 'S24'), ('length', '<f4'), ('sorted_symbol', 'S24'), ('symbol_record', '<i4')])
+
+    def __init__(self, records):
+        self.records = records
+
+    @staticmethod
+    def load(filename):
+        return GeneIndex(np.load(filename, mmap_mode='r'))
+
+    def _search(self, field, key):
+        # binary search on the mapped field, numpy.searchsorted would copy the strided column
+        if not key:
+            return None
+        key = str(key).encode('ascii')
+        column = self.records[field]
+        lo, hi = 0, len(column)
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if column[mid] < key:
+                lo = mid + 1
+            else:
+                hi = mid
+        return lo if lo < len(column) and column[lo] == key else None
+
+    def _record(self, gene_id):
+        if str(gene_id).startswith('ENSG'):
+            return self._search('ensembl', gene_id)
+        idx = self._search('sorted_symbol', gene_id)
+        return None if idx is None else self.records['symbol_record'][idx]
+
+    def length(self, gene_id):
+        idx = self._record(gene_id)
+        return None if idx is None else float(self.records['length'][idx])
+
+    def symbol(self, ensembl_id):
+        idx = self._search('ensembl', ensembl_id)
+        return None if idx is None else self.records['symbol'][idx].decode('ascii') or None
+
+    def ensembl_id(self, symbol):
+        idx = self._record(symbol)
+        return None if idx is None else self.records['ensembl'][idx].decode('ascii')
+
+
+def build_gene_index(filename, index_file):
+    """
+    builds the binary gene index from the tab separated coding gene list (Ensembl gene id, HGNC symbol, length)
+    """
+    genes = {}
+    with open(filename, 'r') as inp:
+        for l in inp:
+            ids = l.rstrip('\n').split('\t')
+            genes[ids[0]] = (ids[1], float(ids[2].strip()))
+
+    ensembl_ids = sorted(genes.keys())
+    records = np.zeros(len(ensembl_ids), dtype=GeneIndex.DTYPE)
+    records['ensembl'] = [e.encode('ascii') for e in ensembl_ids]
+    records['symbol'] = [genes[e][0].encode('ascii') for e in ensembl_ids]
+    records['length'] = [genes[e][1] for e in ensembl_ids]
+    order = np.argsort(records['symbol'], kind='mergesort')
+    records['sorted_symbol'] = records['symbol'][order]
+    records['symbol_record'] = order
+    # concurrent runs must not see a partial index
+    with atomic_output(index_file) as out:
+        np.save(out, records)
+
+
+def load_gene_index(filename):
+    """
+    loads the prebuilt gene index (.npy), for a coding gene list the index is built next to it (or in the
+    working directory if that is not writable) if missing or outdated
+    """
+    if filename.endswith('.npy'):
+        return GeneIndex.load(filename)
+    index_file = os.path.splitext(filename)[0] + '.npy'
+    if not os.access(os.path.dirname(os.path.abspath(index_file)), os.W_OK):
+        index_file = os.path.join(os.getcwd(), os.path.basename(index_file))
+    if not os.path.exists(index_file) or os.path.getmtime(index_file) < os.path.getmtime(filename):
+        logging.info("Building gene index {}".format(index_file))
+        build_gene_index(filename, index_file)
+    return GeneIndex.load(index_file)
+
+
+def resolve_gene_id_system(ids):
+    # Ensembl gene ids or HGNC symbols, decided once on the first id
+    for i in ids:
+        if i and not str(i).startswith('__'):
+            return 'ensembl' if str(i).startswith('ENSG') else 'symbol'
+    return 'ensembl'
+
+
+def map_genes_to_features(genes, gene_index, feature_system):
+    """
+    maps the ids of the gene column to the id system of the expression features, genes are only translated
+    if the id systems differ
+    """
+    unique_genes = set([g for gs in genes for g in str(gs).split(',') if g])
+    if gene_index is None or resolve_gene_id_system(unique_genes) == feature_system:
+        return dict([(g, g) for g in unique_genes])
+    translate = gene_index.symbol if feature_system == 'symbol' else gene_index.ensembl_id
+    return dict([(g, translate(g) or g) for g in unique_genes])
+
+
 #defined as : RPKM = (10^9 * C)/(N * L)
 # L = exon length in base-pairs for a gene
 # C = Number of reads mapped to a gene in a single sample
 # N = total (unique)mapped reads in the sample
-def create_expression_column_value_for_result(row, dict, deseq, gene_id_lengths):
-    ts = row['gene'].split(',')
+def create_expression_column_value_for_result(row, dict, deseq, gene_index, feature_map, total_counts):
+    ts = [feature_map.get(g, g) for g in row['gene'].split(',')]
     values = []
     if deseq:
         for t in ts:
@@ -606,11 +978,12 @@ def create_expression_column_value_for_result(row, dict, deseq, gene_id_lengths)
                 values.append(np.nan)
     else:
         for t in ts:
-            if t in dict:
-                if t in gene_id_lengths:
-                    values.append((10.0**9 * float(dict[t])) / (float(gene_id_lengths[t]) * sum([float(dict[k]) for k in dict.keys() if ((not k.startswith('__')) & (k in gene_id_lengths))])))
+            if t in dict and total_counts > 0:
+                length = gene_index.length(t) if gene_index is not None else None
+                if length is not None:
+                    values.append((10.0**9 * float(dict[t])) / (length * total_counts))
                 else:
-                    values.append((10.0**9 * float(dict[t])) / (float(len(row[0].get_all_transcripts()[0])) * sum([float(dict[k]) for k in dict.keys() if ((not k.startswith('__')) & (k in gene_id_lengths))])))
+                    values.append((10.0**9 * float(dict[t])) / (float(len(row[0].get_all_transcripts()[0])) * total_counts))
                     logging.warning("FKPM value will be based on transcript length for {gene}. Because gene could not be found in the DB".format(gene=t))
             else:
                 values.append(np.nan)
@@ -645,6 +1018,41 @@ def create_ligandomics_column_value_for_result(row, lig_id, val, wild_type):
         return ''
 
 
+def compute_prediction_statistics(df, dropped=None):
+    """
+    computes the binder statistics of the report
+    :param df: dataframe with prediction results
+    :param dropped: DroppedPredictions of the output filter, counted in all values
+    :return: dictionary with the statistics values
+    """
+    dropped = dropped if dropped is not None else DroppedPredictions()
+    binder_cols = [col for col in df.columns if 'binder' in str(col)]
+    allele_binders = Counter(dropped.allele_binders)
+    method_binders = Counter(dropped.method_binders)
+    binder_sequences = set(dropped.binder_sequences)
+    sequences = set(dropped.sequences)
+    binders = dropped.binders
+
+    if not df.empty and 'sequence' in df.columns:
+        binder_values = df[binder_cols] == True
+        is_binder = binder_values.any(axis=1)
+        binder_by_sequence = is_binder.groupby(df['sequence'].map(str)).any()
+
+        binders += int(is_binder.sum())
+        for c in binder_cols:
+            allele_binders[c.replace(' binder', '')] += int(binder_values[c].sum())
+        for m, n in is_binder.groupby(df['method']).sum().iteritems():
+            method_binders[m] += int(n)
+        sequences.update(binder_by_sequence.index)
+        binder_sequences.update(binder_by_sequence.index[binder_by_sequence.values])
+
+    predictions = df.shape[0] + dropped.predictions
+    return {'predictions': predictions, 'binders': binders, 'nonbinders': predictions - binders,
+            'uniquebinders': len(binder_sequences), 'uniquenonbinders': len(sequences - binder_sequences), 'dropped': dropped.predictions,
+            'allelebinders': '\n'.join(['{}: {}'.format(a, n) for a, n in sorted(allele_binders.items())]) or '-',
+            'methodbinders': '\n'.join(['{}: {}'.format(m, n) for m, n in sorted(method_binders.items())]) or '-'}
+
+
 def write_prediction_report(values):
     s = Template(REPORT_TEMPLATE)
     return s.substitute(values)
@@ -758,6 +1166,359 @@ def create_binder_values(aff, method):
     else:
         return np.nan
 
+def get_chunk_size(method, n_peptides, threads):
+    """
+    chunks should be small enough to keep all workers busy, but large enough to not pay the start-up
+    costs (loading allele data) of the external tool too often
+    """
+    chunk_size = int(math.ceil(n_peptides / float(max(threads, 1))))
+    return max(1, min(EXTERNAL_METHODS[method], chunk_size))
+
+
+def run_mixed_length_command(predictor, sequences, alleles):
+    """
+    runs an external predictor binary once on peptides of several lengths, like the Fred2 wrapper
+    (AExternalEpitopePrediction.predict) does for each single length
+    :param predictor: FRED2 external epitope predictor
+    :param sequences: list of peptide sequences
+    :param alleles: list of FRED2 alleles
+    :return: dictionary allele string: dictionary sequence: score
+    """
+    if not predictor.is_in_path():
+        raise RuntimeError("{name} {version} could not be found in PATH".format(name=predictor.name, version=predictor.version))
+    external_version = predictor.get_external_version()
+    if external_version is not None and predictor.version != external_version:
+        raise RuntimeError("Internal version {internal} does not match external version {external}".format(internal=predictor.version, external=external_version))
+
+    allele_strings = dict((conv, str(a)) for conv, a in zip(predictor.convert_alleles(alleles), alleles) if str(a) in predictor.supportedAlleles)
+    allele_groups = sorted(allele_strings.keys())
+    scores = defaultdict(dict)
+
+    fd, peptide_file = tempfile.mkstemp()
+    out_fd, out_file = tempfile.mkstemp()
+    os.close(out_fd)
+    try:
+        with os.fdopen(fd, 'w') as tmp:
+            predictor.prepare_input(sequences, tmp)
+        # the binaries accept at most 50 alleles per call
+        for i in xrange(0, len(allele_groups), 50):
+            cmd = predictor.command % (peptide_file, ','.join(allele_groups[i:i + 50]), '', out_file)
+            proc = subprocess.Popen(cmd, shell=True, stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+            output = proc.communicate()[0]
+            if proc.returncode != 0:
+                raise RuntimeError("Unsuccessful execution of {cmd} (exit code {code}): {output}".format(cmd=cmd, code=proc.returncode, output=output))
+            for a, s in predictor.parse_external_result(out_file).iteritems():
+                scores[allele_strings[a]].update(s)
+    finally:
+        os.remove(peptide_file)
+        os.remove(out_file)
+    return scores
+
+
+def _run_external_chunk(method, version, sequences, alleles, conn):
+    # own process group, so that the external binary can be killed together with the worker
+    os.setpgrp()
+    try:
+        predictor = EpitopePredictorFactory(method, version=version)
+        if '{}-{}'.format(method, version) in MIXED_LENGTH_METHODS:
+            scores = run_mixed_length_command(predictor, sequences, [Allele(a) for a in alleles])
+        else:
+            result = predictor.predict([Peptide(s) for s in sequences], alleles=[Allele(a) for a in alleles])
+            scores = {}
+            for a in result.columns:
+                scores[str(a)] = dict((str(idx[0]), score) for idx, score in result[a].iteritems())
+        conn.send((True, scores))
+    except Exception as e:
+        conn.send((False, str(e)))
+    conn.close()
+
+
+def run_external_predictor(m, peptides, alleles, threads=1, timeout=None, retries=1):
+    """
+    runs an external predictor binary on chunks of the peptides in parallel processes, chunks exceeding the
+    timeout are killed and retried, peptides of chunks failing in all attempts are logged and kept without score
+    :param m: method string, e.g. netmhcpan-3.0
+    :param peptides: list of FRED2 peptides
+    :param alleles: list of FRED2 alleles
+    :param threads: maximal number of concurrent predictor processes
+    :param timeout: timeout per chunk in seconds
+    :param retries: number of retries per chunk
+    :return: EpitopePredictionResult
+    """
+    method, version = m.split('-')
+    seq_to_peptide = dict((str(p), p) for p in peptides)
+    # sorted by length first, so that chunks of binaries started per length mostly contain one length
+    sequences = sorted(seq_to_peptide.keys(), key=lambda x: (len(x), x))
+    allele_map = dict((str(a), a) for a in alleles)
+
+    chunk_size = get_chunk_size(m, len(sequences), threads)
+    pending = [(i, sequences[i:i + chunk_size], 0) for i in xrange(0, len(sequences), chunk_size)]
+    running = {}
+    scores = defaultdict(dict)
+    failed_sequences = []
+
+    while pending or running:
+        # fill up the pool
+        while pending and len(running) < threads:
+            chunk_id, chunk, attempt = pending.pop(0)
+            parent_conn, child_conn = multiprocessing.Pipe(duplex=False)
+            proc = multiprocessing.Process(target=_run_external_chunk, args=(method, version, chunk, allele_map.keys(), child_conn))
+            proc.start()
+            child_conn.close()
+            running[chunk_id] = (proc, parent_conn, chunk, attempt, time.time())
+
+        time.sleep(0.1)
+        for chunk_id in list(running.keys()):
+            proc, conn, chunk, attempt, started = running[chunk_id]
+            failed = False
+            # checked before polling: a worker that exited in between has its result in the pipe already
+            exited = not proc.is_alive()
+            if conn.poll():
+                # parse results of finished chunks while the others are still running
+                try:
+                    success, value = conn.recv()
+                except EOFError:
+                    success, value = False, 'worker exited without result'
+                proc.join()
+                if success:
+                    for a, s in value.iteritems():
+                        scores[a].update(s)
+                else:
+                    logging.warning("{method}: chunk {chunk} failed: {error}".format(method=m, chunk=chunk_id, error=value))
+                    failed = True
+            elif exited:
+                proc.join()
+                logging.warning("{method}: chunk {chunk} exited with code {code}".format(method=m, chunk=chunk_id, code=proc.exitcode))
+                failed = True
+            elif timeout is not None and time.time() - started > timeout:
+                try:
+                    os.killpg(proc.pid, signal.SIGKILL)
+                except OSError:
+                    pass
+                proc.join()
+                logging.warning("{method}: chunk {chunk} timed out after {timeout}s".format(method=m, chunk=chunk_id, timeout=timeout))
+                failed = True
+            else:
+                continue
+            conn.close()
+            del running[chunk_id]
+            if failed:
+                if attempt < retries:
+                    pending.append((chunk_id, chunk, attempt + 1))
+                else:
+                    failed_sequences.extend(chunk)
+                    logging.error("{method}: no predictions for {n} peptides of chunk {chunk} after {attempts} attempts: {peptides}".format(method=m, n=len(chunk), chunk=chunk_id, attempts=attempt + 1, peptides=','.join(chunk)))
+
+    if not scores:
+        raise ValueError("No predictions available for {method}.".format(method=m))
+
+    # peptides of failed chunks are kept as rows without score
+    for a in allele_map:
+        scores[a].update((seq, np.nan) for seq in failed_sequences)
+
+    result = EpitopePredictionResult.from_dict(dict((allele_map[a], dict((seq_to_peptide[seq], v) for seq, v in s.iteritems())) for a, s in scores.iteritems()))
+    result.index = pd.MultiIndex.from_tuples([(p, method) for p in result.index], names=['Seq', 'Method'])
+    return result
+
+
+def predict_peptides(m, peptides, alleles):
+    """
+    predicts binding of peptides with method m, external binaries are run chunked and concurrently
+    """
+    if m in EXTERNAL_METHODS:
+        return run_external_predictor(m, peptides, alleles, EXTERNAL_RUNNER['threads'], EXTERNAL_RUNNER['timeout'], EXTERNAL_RUNNER['retries'])
+    return EpitopePredictorFactory(m.split('-')[0], version=m.split('-')[1]).predict(peptides, alleles=alleles)
+
+
+def predict_by_length(methods, peptides_by_length, alleles, uncounted=frozenset()):
+    """
+    predicts peptides of several lengths with one predict call per method and allele set, the results are split
+    back by length. Binaries in MIXED_LENGTH_METHODS are started once per chunk for all lengths. Lengths a method
+    does not support are left out, methods failing on the mixed batch are run per length. In cascade mode each
+    length is run separately (the prefilter cutoffs depend on the length)
+    :param methods: list of method strings
+    :param peptides_by_length: dictionary length: list of FRED2 peptides
+    :param alleles: list of FRED2 alleles
+    :param uncounted: sequences not counted as skipped predictions (co-predicted wild-types)
+    :return: dictionary length: list of EpitopePredictionResults, number of skipped predictions
+    """
+    results_by_length = defaultdict(list)
+    skipped = 0
+    peptides_by_length = dict([(l, peps) for l, peps in peptides_by_length.iteritems() if peps])
+
+    if CASCADE['enabled']:
+        for peplen, peptides in peptides_by_length.iteritems():
+            results, n = predict_cascade(methods, peptides, alleles, peplen, uncounted)
+            results_by_length[peplen].extend(results)
+            skipped += n
+        return results_by_length, skipped
+
+    for m in methods:
+        supported = EpitopePredictorFactory(m.split('-')[0], version=m.split('-')[1]).supportedLength
+        lengths = sorted([l for l in peptides_by_length if l in supported])
+        for peplen in sorted(set(peptides_by_length) - set(lengths)):
+            logging.warning("Prediction for length {length} and allele {allele} not possible with {method}.".format(length=peplen, allele=','.join([str(a) for a in alleles]), method=m))
+        if not lengths:
+            continue
+
+        try:
+            result = predict_peptides(m, [p for l in lengths for p in peptides_by_length[l]], alleles)
+        except Exception:
+            logging.exception("Prediction of lengths {lengths} with {method} failed, predicting each length separately.".format(lengths=','.join([str(l) for l in lengths]), method=m))
+        else:
+            result_lengths = np.array([len(idx[0]) for idx in result.index])
+            for peplen in lengths:
+                mask = result_lengths == peplen
+                if mask.any():
+                    # alleles without a model for this length are left out, as in a prediction of this length only
+                    results_by_length[peplen].append(EpitopePredictionResult(result[mask].dropna(axis=1, how='all')))
+            continue
+
+        for peplen in lengths:
+            try:
+                result = predict_peptides(m, peptides_by_length[peplen], alleles)
+            except Exception as e:
+                logging.warning("Prediction for length {length} and allele {allele} not possible with {method}: {error}".format(length=peplen, allele=','.join([str(a) for a in alleles]), method=m, error=e))
+            else:
+                results_by_length[peplen].append(result)
+    return results_by_length, skipped
+
+
+def read_cascade_thresholds(filename):
+    """
+    reads configured prefilter thresholds of the cascade mode, tab separated with the columns allele, threshold (fraction
+    of the max Syfpeithi score) and optional length (thresholds without length apply to all lengths)
+    :return: dictionary (allele string, length or None): threshold
+    """
+    thresholds = {}
+    with open(filename, 'r') as inp:
+        for row in csv.DictReader(inp, delimiter='\t'):
+            length = int(row['length']) if row.get('length') else None
+            thresholds[(str(Allele(row['allele'])), length)] = float(row['threshold'])
+    return thresholds
+
+
+def calibrate_cascade_cutoffs(methods, peptides, alleles, peplen, prefilter_result):
+    """
+    calibrates prefilter cutoffs on a fixed sample of the peptides: the sample is predicted with the other methods and
+    the cutoff of an allele is the highest prefilter score that keeps CASCADE['recall'] of the binders of the sample
+    :return: dictionary allele string: cutoff (None if the sample contains no binders)
+    """
+    sample = sorted(peptides, key=str)
+    if len(sample) > CASCADE['calibration_size']:
+        rng = np.random.RandomState(peplen)
+        sample = [sample[i] for i in sorted(rng.choice(len(sample), CASCADE['calibration_size'], replace=False))]
+
+    binders = defaultdict(set)
+    for m in methods:
+        if m == CASCADE['prefilter']:
+            continue
+        try:
+            result = predict_peptides(m, sample, alleles)
+        except:
+            logging.warning("Cascade calibration for length {length} not possible with {method}.".format(length=peplen, method=m))
+            continue
+        for a in alleles:
+            if a not in result.columns:
+                continue
+            for idx, score in result[a].iteritems():
+                if create_binder_values(create_affinity_values(a, peplen, score, m, None, None), m) is True:
+                    binders[str(a)].add(str(idx[0]))
+
+    prefilter_scores = dict((a, dict((str(idx[0]), score) for idx, score in prefilter_result[a].iteritems())) for a in alleles if a in prefilter_result.columns)
+    cutoffs = {}
+    for a in alleles:
+        scores = sorted([prefilter_scores[a][seq] for seq in binders[str(a)] if a in prefilter_scores and not pd.isnull(prefilter_scores[a].get(seq))])
+        cutoffs[str(a)] = scores[int(math.floor((1.0 - CASCADE['recall']) * len(scores)))] if scores else None
+    return cutoffs
+
+
+def get_cascade_cutoff(allele, peplen, cutoffs):
+    """
+    prefilter cutoff of an allele: configured threshold, calibrated cutoff or the default threshold
+    """
+    max_score = get_matrix_max_score("%s_%s%s" % (allele.locus, allele.supertype, allele.subtype), peplen)
+    for key in [(str(allele), peplen), (str(allele), None)]:
+        if key in CASCADE['thresholds']:
+            return CASCADE['thresholds'][key] * max_score
+    if cutoffs.get(str(allele)) is not None:
+        return cutoffs[str(allele)]
+    return CASCADE['threshold'] * max_score
+
+
+def predict_cascade(methods, peptides, alleles, peplen, uncounted=frozenset()):
+    """
+    scores all peptides with the fast prefilter method first and sends only peptides above the cutoff for an
+    allele to the other methods, pruned predictions are kept as rows without score. Peptides surviving for the
+    same alleles are predicted together, one call per method and allele set
+    :param methods: list of method strings
+    :param peptides: list of FRED2 peptides of length peplen
+    :param alleles: list of FRED2 alleles
+    :param peplen: peptide length
+    :param uncounted: sequences not counted as skipped predictions (co-predicted wild-types)
+    :return: list of EpitopePredictionResults, number of skipped predictions
+    """
+    prefilter = CASCADE['prefilter']
+    try:
+        prefilter_result = predict_peptides(prefilter, peptides, alleles)
+    except:
+        logging.warning("Cascade prefilter {method} not possible for length {length}, predicting all peptides.".format(method=prefilter, length=peplen))
+        prefilter_result = None
+
+    results = [prefilter_result] if prefilter in methods and prefilter_result is not None else []
+
+    # cutoffs of alleles without configured threshold are calibrated once per length and run
+    if prefilter_result is not None:
+        uncalibrated = [a for a in alleles if (str(a), peplen) not in CASCADE['cutoffs'] and (str(a), peplen) not in CASCADE['thresholds']
+                        and (str(a), None) not in CASCADE['thresholds']]
+        if uncalibrated:
+            for a, cutoff in calibrate_cascade_cutoffs(methods, peptides, uncalibrated, peplen, prefilter_result).iteritems():
+                CASCADE['cutoffs'][(a, peplen)] = cutoff
+                logging.info("Cascade: calibrated cutoff {cutoff} for {allele} and length {length}".format(cutoff=cutoff, allele=a, length=peplen))
+    cutoffs = dict((a, c) for (a, l), c in CASCADE['cutoffs'].iteritems() if l == peplen)
+
+    # alleles each peptide survives the prefilter for
+    survivor_alleles = defaultdict(list)
+    for a in alleles:
+        cutoff = get_cascade_cutoff(a, peplen, cutoffs)
+        if prefilter_result is None or a not in prefilter_result.columns or pd.isnull(cutoff):
+            # no prefilter model available for this allele, nothing can be pruned
+            for p in peptides:
+                survivor_alleles[p].append(a)
+        else:
+            for idx, score in prefilter_result[a].iteritems():
+                if pd.isnull(score) or score >= cutoff:
+                    survivor_alleles[idx[0]].append(a)
+
+    groups = defaultdict(list)
+    for p in peptides:
+        if survivor_alleles[p]:
+            groups[tuple(survivor_alleles[p])].append(p)
+
+    counted = [p for p in peptides if str(p) not in uncounted]
+    skipped = 0
+    for m in methods:
+        if m == prefilter:
+            continue
+        skipped += sum([len(alleles) - len(survivor_alleles[p]) for p in counted])
+        group_results = []
+        for group_alleles, group_peptides in groups.iteritems():
+            try:
+                group_results.append(predict_peptides(m, group_peptides, list(group_alleles)))
+            except:
+                logging.warning("Prediction for length {length} and allele {allele} not possible with {method}.".format(length=peplen, allele=','.join([str(a) for a in group_alleles]), method=m))
+        if not group_results:
+            continue
+        method_name = group_results[0].index.get_level_values('Method')[0]
+        df = pd.concat(group_results)
+        df = df.reindex(index=pd.MultiIndex.from_tuples([(p, method_name) for p in peptides], names=['Seq', 'Method']),
+                        columns=[a for a in alleles if any(a in r.columns for r in group_results)])
+        results.append(EpitopePredictionResult(df))
+
+    logging.info("Cascade: skipped {skipped} predictions for length {length} in {groups} allele groups".format(skipped=skipped, length=peplen, groups=len(groups)))
+    return results, skipped
+
+
 def generate_wt_seqs(peptides):
     wt_dict = {}
 
@@ -799,120 +1560,1498 @@ def generate_wt_seqs(peptides):
     return wt_dict
 
 
-def make_predictions_from_variants(variants_all, methods, alleles, minlength, maxlength, martsadapter, protein_db, identifier, metadata, transcriptProteinMap):
-    # list for all peptides and filtered peptides
-    all_peptides = []
-    all_peptides_filtered = []
+class WildTypeReconstructor(object):
+    """
+    reconstructs wild-type sequences of mutated peptides by slicing the wild-type protein at the peptide offset,
+    wild-type proteins are built once per protein from the cached parsed mutation syntax of its variants.
+    Proteins with variants other than SNVs fall back to generate_wt_seqs.
+    """
+    SNV_PATTERN = re.compile("([a-zA-Z]+)([0-9]+)([a-zA-Z]+)")
+
+    def __init__(self):
+        self.syntax_cache = {}
+        self.protein_cache = {}
+
+    def parse_syntax(self, v, transcript_id):
+        # wild-type amino acid of a SNV, None if not available
+        key = (v.id, v.genomePos, v.obs, transcript_id)
+        if key not in self.syntax_cache:
+            wt = None
+            if v.type == VariationType.SNP:
+                mut_syntax = v.coding[transcript_id].aaMutationSyntax
+                m = self.SNV_PATTERN.match(mut_syntax.split('.')[-1]) if '?' not in mut_syntax else None
+                if m is not None:
+                    wt = SeqUtils.seq1(m.groups()[0])
+            self.syntax_cache[key] = wt
+        return self.syntax_cache[key]
+
+    def get_wt_protein(self, protein):
+        # wild-type protein sequence or None if the protein carries variants other than SNVs
+        protein_id = protein.transcript_id
+        if protein_id not in self.protein_cache:
+            transcript_id = protein_id.split(':')[0]
+            wt_protein = list(str(protein))
+            for pos, var_list in protein.vars.iteritems():
+                for v in var_list:
+                    wt = self.parse_syntax(v, transcript_id)
+                    if wt is None:
+                        wt_protein = None
+                        break
+                    wt_protein[pos] = wt
+                if wt_protein is None:
+                    break
+            self.protein_cache[protein_id] = ''.join(wt_protein) if wt_protein is not None else None
+        return self.protein_cache[protein_id]
+
+    def get(self, peptide, protein_id):
+        """
+        :return: wild-type sequence, np.nan if not available, None if the peptide is not mutated in this protein
+        """
+        if isinstance(peptide, NeoORFPeptide):
+            return peptide.get_wt_sequence(protein_id)
+        protein = peptide.proteins[protein_id]
+        # the peptide can occur several times in the protein, the wild-type is taken at an occurrence covering a variant
+        starts = [start for start in peptide.get_protein_positions(protein_id) if any(pos in protein.vars for pos in xrange(start, start + len(peptide)))]
+        if not starts:
+            return None
+        start = starts[0]
+        wt_protein = self.get_wt_protein(protein)
+        if wt_protein is None:
+            return generate_wt_seqs([peptide]).get('{}_{}'.format(str(peptide), protein_id), None)
+        return wt_protein[start:start + len(peptide)]
 
-    # dictionaries for syfpeithi matrices max values and allele mapping
-    max_values_matrices = {}
-    allele_string_map = {}
 
-    # list to hold dataframes for all predictions
-    pred_dataframes = []
+# protein of a StoredPeptide, only the id is kept
+StoredTranscript = namedtuple('StoredTranscript', ['transcript_id'])
 
-    prots = [p for p in generator.generate_proteins_from_transcripts(generator.generate_transcripts_from_variants(variants_all.values(), martsadapter, ID_SYSTEM_USED))]
 
-    for peplen in range(minlength, maxlength):
-        peptide_gen = generator.generate_peptides_from_proteins(prots, peplen)
+class PeptideStore(object):
+    """
+    compact store of the filtered peptides of a run: the sequences are packed into one uint8 buffer with offsets,
+    the provenance is kept as integer arrays of (transcript, variant) rows per peptide indexing the transcript and
+    variant tables. FRED2 peptides with their protein and variant dictionaries only exist for the length being
+    generated, chunks are predicted and annotated as StoredPeptides reading the provenance from the arrays
+    """
 
-        peptides_var = [x for x in peptide_gen]
+    def __init__(self):
+        self.transcripts = ShardStringTable()
+        self.variants = []
+        self.variant_index = {}
+        self.buffer = np.zeros(0, dtype=np.uint8)
+        self.offsets = np.zeros(1, dtype=np.int64)
+        self.novel = np.zeros(0, dtype=bool)
+        # provenance rows of peptide i are provenance_start[i]:provenance_start[i + 1], variant -1 for proteins
+        # the peptide does not cover a variant of
+        self.provenance_start = np.zeros(1, dtype=np.int64)
+        self.provenance_transcript = np.zeros(0, dtype=np.int32)
+        self.provenance_variant = np.zeros(0, dtype=np.int32)
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def add_variant(self, v):
+        if id(v) not in self.variant_index:
+            self.variant_index[id(v)] = len(self.variants)
+            self.variants.append(v)
+        return self.variant_index[id(v)]
+
+    def extend(self, peptides):
+        """
+        packs FRED2 peptides (all peptides of one length), the arrays grow once per call
+        :param peptides: list of FRED2 peptides or NeoORFPeptides
+        """
+        if not peptides:
+            return
+        transcripts = []
+        variants = []
+        counts = []
+        for p in peptides:
+            n = len(transcripts)
+            for t in set([x.transcript_id for x in p.get_all_transcripts()]):
+                for v in set(p.get_variants_by_protein(t)) or [None]:
+                    transcripts.append(self.transcripts.add(t))
+                    variants.append(self.add_variant(v) if v is not None else -1)
+            counts.append(len(transcripts) - n)
+
+        sequences = np.frombuffer(''.join([str(p) for p in peptides]).encode('ascii'), dtype=np.uint8)
+        self.buffer = np.concatenate([self.buffer, sequences])
+        self.offsets = np.concatenate([self.offsets, self.offsets[-1] + np.cumsum([len(p) for p in peptides], dtype=np.int64)])
+        self.novel = np.concatenate([self.novel, np.array([isinstance(p, NeoORFPeptide) and p.novel for p in peptides], dtype=bool)])
+        self.provenance_start = np.concatenate([self.provenance_start, self.provenance_start[-1] + np.cumsum(counts, dtype=np.int64)])
+        self.provenance_transcript = np.concatenate([self.provenance_transcript, np.array(transcripts, dtype=np.int32)])
+        self.provenance_variant = np.concatenate([self.provenance_variant, np.array(variants, dtype=np.int32)])
+
+    def sequence(self, i):
+        return str(self.buffer[self.offsets[i]:self.offsets[i + 1]].tobytes().decode('ascii'))
+
+    def provenance(self, i):
+        """
+        :return: list of (transcript id, FRED2 variant or None) of peptide i
+        """
+        rows = xrange(self.provenance_start[i], self.provenance_start[i + 1])
+        return [(self.transcripts.strings[self.provenance_transcript[r]], self.variants[self.provenance_variant[r]] if self.provenance_variant[r] >= 0 else None)
+                for r in rows]
 
-        # remove peptides which are not 'variant relevant'
-        peptides = [x for x in peptides_var if any(x.get_variants_by_protein(y) for y in x.proteins.keys())]
+    def peptides(self, start, stop):
+        return [StoredPeptide(self, i) for i in xrange(start, min(stop, len(self)))]
 
-        # filter out self peptides
-        selfies = [str(p) for p in peptides if protein_db.exists(str(p))]
-        filtered_peptides = [p for p in peptides if str(p) not in selfies]
 
-        all_peptides = all_peptides + peptides
-        all_peptides_filtered = all_peptides_filtered + filtered_peptides
+class StoredPeptide(Peptide):
+    """
+    peptide of a PeptideStore, implements the parts of the FRED2 peptide interface used for the result columns
+    (like NeoORFPeptide) from the provenance rows of the store
+    """
 
-        results = []
+    def __init__(self, store, i):
+        Peptide.__init__(self, store.sequence(i))
+        self.store = store
+        self.store_index = i
+        self.novel = bool(store.novel[i])
 
-        if len(filtered_peptides) > 0:
-            for m in methods:
-                try:
-                    results.extend([EpitopePredictorFactory(m.split('-')[0], version=m.split('-')[1]).predict(filtered_peptides, alleles=alleles)])
-                except:
-                    logging.warning("Prediction for length {length} and allele {allele} not possible with {method}.".format(length=peplen, allele=','.join([str(a) for a in alleles]), method=m))
+    def get_all_transcripts(self):
+        return [StoredTranscript(t) for t in set([t for t, v in self.store.provenance(self.store_index)])]
 
-        if(len(results) == 0):
-            continue
+    def get_variants_by_protein(self, transcript_id):
+        return [v for t, v in self.store.provenance(self.store_index) if t == transcript_id and v is not None]
 
-        df = results[0].merge_results(results[1:])
 
-        for a in alleles:
-            conv_allele = "%s_%s%s" % (a.locus, a.supertype, a.subtype)
-            allele_string_map['%s_%s' % (a, peplen)] = '%s_%i' % (conv_allele, peplen)
-            max_values_matrices['%s_%i' % (conv_allele, peplen)] = get_matrix_max_score(conv_allele, peplen)
+@contextmanager
+def atomic_output(filename, mode='wb'):
+    """
+    writes to a unique temporary file next to filename that replaces filename once the block completed, so that
+    concurrent tasks neither see partial files nor write into the same temporary file
+    """
+    fd, tmp_file = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(filename)), prefix='.{}.'.format(os.path.basename(filename)))
+    try:
+        with os.fdopen(fd, mode) as out:
+            yield out
+        os.chmod(tmp_file, 0o644)
+        os.rename(tmp_file, filename)
+    except:
+        os.remove(tmp_file)
+        raise
 
-        df.insert(0, 'length', df.index.map(create_length_column_value))
-        df['chr'] = df.index.map(create_variant_chr_column_value)
-        df['pos'] = df.index.map(create_variant_pos_column_value)
-        df['gene'] = df.index.map(create_gene_column_value)
-        df['transcripts'] = df.index.map(create_transcript_column_value)
-        df['proteins'] = df.index.map(create_protein_column_value)
-        df['variant type'] = df.index.map(create_variant_type_column_value)
-        df['synonymous'] = df.index.map(create_variant_syn_column_value)
-        df['homozygous'] = df.index.map(create_variant_hom_column_value)
-        df['variant details (genomic)'] = df.index.map(create_mutationsyntax_genome_column_value)
-        df['variant details (protein)'] = df.index.map(create_mutationsyntax_column_value)
 
-        # reset index to have index as columns
-        df.reset_index(inplace=True)
+def _read_fasta(filename):
+    """
+    parses a (multi-)FASTA file
+    :return: list of (id, sequence) tuples, id is the first word of the header
+    """
+    entries = []
+    with open(filename, 'r') as inp:
+        header, seq = None, []
+        for l in inp:
+            l = l.strip()
+            if l.startswith('>'):
+                if header is not None:
+                    entries.append((header, ''.join(seq)))
+                header, seq = l[1:].split()[0] if len(l) > 1 else '', []
+            elif l:
+                seq.append(l.upper())
+        if header is not None:
+            entries.append((header, ''.join(seq)))
+    return entries
+
+
+def _file_checksum(filename):
+    md5 = hashlib.md5()
+    with open(filename, 'rb') as inp:
+        for block in iter(lambda: inp.read(1 << 20), b''):
+            md5.update(block)
+    return md5.hexdigest()
+
+
+class MappedProteinDB(object):
+    """
+    memory-mapped reference proteome, all sequences are stored in one '#'-separated blob with an id index,
+    so parallel workers share the same pages without copying. Drop-in for UniProtDB.exists.
+    """
 
-        for c in df.columns:
-            if '*' in str(c):
-                idx = df.columns.get_loc(c)
-                df.insert(idx + 1, '%s affinity' % c, df.apply(lambda x: create_affinity_values(str(c), int(x['length']), float(x[c]), x['Method'], max_values_matrices, allele_string_map), axis=1))
-                df.insert(idx + 2, '%s binder' % c, df.apply(lambda x: create_binder_values(float(x['%s affinity' % c]), x['Method']), axis=1))
-                df = df.rename(columns={c: '%s score' % c})
-                df['%s score' % c] = df['%s score' % c].map(lambda x: round(x, 4))
+    def __init__(self, blob_file, index_file):
+        self.index = {}
+        with open(index_file, 'r') as inp:
+            for l in inp:
+                protein_id, offset, length = l.rstrip('\n').split('\t')
+                self.index[protein_id] = (int(offset), int(length))
+        self.blob_file = blob_file
+        self._file = open(blob_file, 'rb')
+        self.blob = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ) if os.path.getsize(blob_file) > 0 else b''
 
-        for c in metadata:
-            df[c] = df.apply(lambda row: create_metadata_column_value(row, c), axis=1)
+    def __len__(self):
+        return len(self.index)
 
-        df = df.rename(columns={'Seq': 'sequence'})
-        df = df.rename(columns={'Method': 'method'})
-        pred_dataframes.append(df)
+    def exists(self, seq):
+        return self.blob.find(str(seq).encode('ascii')) != -1
 
-    statistics = {'date': datetime.now().strftime("%Y-%m-%d %H:%M:%S"), 'sample': identifier, 'alleles': '\n'.join([str(a) for a in alleles]),
-        'methods': '\n'.join(methods), 'variants': len(variants_all), 'peptides': len(all_peptides), 'filter': len(all_peptides_filtered)}
+    def find_proteins(self, seq):
+        """
+        yields the sequences of the proteins containing seq, once per protein entry
+        """
+        seq = str(seq).encode('ascii')
+        pos = self.blob.find(seq)
+        while pos != -1:
+            start = self.blob.rfind(b'#', 0, pos) + 1
+            end = self.blob.find(b'#', pos)
+            yield self.blob[start:end].decode('ascii')
+            pos = self.blob.find(seq, end)
 
-    return pred_dataframes, statistics, all_peptides_filtered
+    def get_sequence(self, protein_id):
+        offset, length = self.index[protein_id]
+        return self.blob[offset:offset + length].decode('ascii')
 
 
-def make_predictions_from_peptides(peptides, methods, alleles, protein_db, identifier, metadata):
-    # dictionaries for syfpeithi matrices max values and allele mapping
-    max_values_matrices = {}
-    allele_string_map = {}
+def load_reference_proteome(path, threads=1, cache_dir=None):
+    """
+    loads all FASTA files of the reference proteome (file or directory), parsed files are cached in the cache
+    directory keyed by the checksums of the input files, the reference itself is never written to
+    :param path: /path/to/fasta or /path/to/directory
+    :param threads: number of parallel parser processes
+    :param cache_dir: directory of the parsed proteome caches, default: working directory
+    :return: MappedProteinDB
+    """
+    if os.path.isdir(path):
+        files = sorted([os.path.join(path, f) for f in os.listdir(path) if f.endswith(".fasta") or f.endswith(".fsa")])
+    else:
+        files = [path]
+    cache_dir = cache_dir or os.getcwd()
+    if not os.path.isdir(cache_dir):
+        os.makedirs(cache_dir)
 
-    # list to hold dataframes for all predictions
-    pred_dataframes = []
+    pool = multiprocessing.Pool(max(1, min(threads, len(files))))
+    try:
+        checksums = pool.map(_file_checksum, files)
+        key = hashlib.md5(''.join(['{}:{};'.format(os.path.basename(f), c) for f, c in zip(files, checksums)]).encode('ascii')).hexdigest()
+        blob_file = os.path.join(cache_dir, 'epaa_proteome_{}.seq'.format(key))
+        index_file = os.path.join(cache_dir, 'epaa_proteome_{}.idx'.format(key))
+
+        if not (os.path.exists(blob_file) and os.path.exists(index_file)):
+            logging.info("Parsing reference proteome, cache: {}".format(blob_file))
+            offset = 0
+            # concurrent runs must not see partial caches, the index is renamed last
+            with atomic_output(index_file, 'w') as index:
+                with atomic_output(blob_file) as blob:
+                    for entries in pool.imap(_read_fasta, files):
+                        for protein_id, seq in entries:
+                            blob.write(seq.encode('ascii') + b'#')
+                            index.write('{}\t{}\t{}\n'.format(protein_id, offset, len(seq)))
+                            offset += len(seq) + 1
+        else:
+            logging.info("Using cached reference proteome {}".format(blob_file))
+    finally:
+        pool.close()
+        pool.join()
 
-    # filter out self peptides if specified
-    selfies = [str(p) for p in peptides if protein_db.exists(str(p))]
-    peptides_filtered = [p for p in peptides if str(p) not in selfies]
+    return MappedProteinDB(blob_file, index_file)
 
-    # sort peptides by length (for predictions)
-    sorted_peptides = {}
 
-    for p in peptides_filtered:
-        length = len(str(p))
-        if length in sorted_peptides:
-            sorted_peptides[length].append(p)
-        else:
-            sorted_peptides[length] = [p]
+class BloomFilter(object):
+    """
+    persisted Bloom filter over all peptide windows of the given lengths of a protein blob, answers
+    'definitely not contained' without touching the sequences. Uses double hashing of two polynomial hashes.
+    """
+    MASK = (1 << 64) - 1
+    P1 = 0x100000001b3
+    P2 = 0x9e3779b97f4a7c15
+
+    def __init__(self, bits, n_bits, n_hashes, lengths):
+        self.bits = bits
+        self.n_bits = n_bits
+        self.n_hashes = n_hashes
+        self.lengths = frozenset(lengths)
+
+    def __contains__(self, seq):
+        h1, h2 = 0, 0
+        for c in bytearray(str(seq).encode('ascii')):
+            h1 = (h1 * self.P1 + c) & self.MASK
+            h2 = (h2 * self.P2 + c) & self.MASK
+        h2 |= 1
+        for i in xrange(self.n_hashes):
+            pos = ((h1 + i * h2) & self.MASK) % self.n_bits
+            if not self.bits[pos >> 3] & (1 << (pos & 7)):
+                return False
+        return True
+
+    @staticmethod
+    def _window_hashes(arr, length):
+        # polynomial hashes of all windows without separator, uint64 arithmetic wraps like MASK above
+        n_windows = len(arr) - length + 1
+        if n_windows <= 0:
+            return np.zeros(0, dtype=np.uint64), np.zeros(0, dtype=np.uint64)
+        values = arr.astype(np.uint64)
+        h1 = np.zeros(n_windows, dtype=np.uint64)
+        h2 = np.zeros(n_windows, dtype=np.uint64)
+        for j in xrange(length):
+            h1 = h1 * np.uint64(BloomFilter.P1) + values[j:j + n_windows]
+            h2 = h2 * np.uint64(BloomFilter.P2) + values[j:j + n_windows]
+        separators = np.concatenate([[0], np.cumsum(arr == ord('#'))])
+        valid = (separators[length:] - separators[:n_windows]) == 0
+        return h1[valid], h2[valid] | np.uint64(1)
+
+    @classmethod
+    def _chunks(cls, blob, length, chunk_size):
+        # overlapping chunks, every window is contained in exactly one chunk
+        arr = np.frombuffer(blob, dtype=np.uint8)
+        for start in xrange(0, max(len(arr) - length + 1, 0), chunk_size):
+            yield cls._window_hashes(arr[start:start + chunk_size + length - 1], length)
+
+    @classmethod
+    def build(cls, blob, lengths, fpr=0.01, chunk_size=1 << 22):
+        n = sum([len(h1) for length in lengths for h1, h2 in cls._chunks(blob, length, chunk_size)])
+        n_bits = max(64, int(math.ceil(-max(n, 1) * math.log(fpr) / math.log(2) ** 2)))
+        n_hashes = max(1, int(round(n_bits / float(max(n, 1)) * math.log(2))))
+        bits = np.zeros((n_bits + 7) // 8, dtype=np.uint8)
+        for length in lengths:
+            for h1, h2 in cls._chunks(blob, length, chunk_size):
+                for i in xrange(n_hashes):
+                    pos = (h1 + np.uint64(i) * h2) % np.uint64(n_bits)
+                    for b in xrange(8):
+                        selected = pos[(pos & np.uint64(7)) == b]
+                        bits[selected >> np.uint64(3)] |= np.uint8(1 << b)
+        return cls(bits, n_bits, n_hashes, lengths)
+
+    def save(self, filename):
+        # the parameters first, the filter file marks a complete cache
+        with atomic_output(filename + '.params', 'w') as out:
+            out.write('{}\t{}\t{}\n'.format(self.n_bits, self.n_hashes, ','.join([str(l) for l in sorted(self.lengths)])))
+        with atomic_output(filename) as out:
+            np.save(out, self.bits)
+
+    @classmethod
+    def load(cls, filename):
+        with open(filename + '.params', 'r') as inp:
+            n_bits, n_hashes, lengths = inp.readline().strip().split('\t')
+        return cls(np.load(filename, mmap_mode='r'), int(n_bits), int(n_hashes), [int(l) for l in lengths.split(',')])
+
+
+class TieredProteinDB(object):
+    """
+    self-filter against several proteomes, a Bloom filter per proteome rules out most peptides and the
+    exact (memory-mapped) lookup only runs on Bloom filter hits or for lengths the filter was not built for
+    """
+
+    def __init__(self, tiers):
+        self.tiers = tiers
+
+    def exists(self, seq):
+        seq = str(seq)
+        for bloom, db in self.tiers:
+            if (len(seq) not in bloom.lengths or seq in bloom) and db.exists(seq):
+                return True
+        return False
+
+    def find_proteins(self, seq):
+        seq = str(seq)
+        for bloom, db in self.tiers:
+            if len(seq) not in bloom.lengths or seq in bloom:
+                for protein in db.find_proteins(seq):
+                    yield protein
+
+
+def load_tiered_proteomes(paths, lengths, threads=1, fpr=0.01, cache_dir=None):
+    """
+    loads each reference proteome memory-mapped and builds or loads its persisted Bloom filter
+    :param paths: list of FASTA files or directories, one per proteome
+    :param lengths: peptide lengths the Bloom filters are built for
+    :param cache_dir: directory of the proteome caches, the Bloom filters are stored next to them
+    :return: TieredProteinDB
+    """
+    tiers = []
+    for path in paths:
+        db = load_reference_proteome(path, threads, cache_dir)
+        bloom_file = '{}.bloom_{}_{}.npy'.format(db.blob_file, '-'.join([str(l) for l in lengths]), fpr)
+        if os.path.exists(bloom_file) and os.path.exists(bloom_file + '.params'):
+            bloom = BloomFilter.load(bloom_file)
+        else:
+            logging.info("Building Bloom filter for {}".format(path))
+            bloom = BloomFilter.build(db.blob, lengths, fpr)
+            bloom.save(bloom_file)
+        tiers.append((bloom, db))
+    return TieredProteinDB(tiers)
+
+
+class PersonalizedProteinDB(object):
+    """
+    self-filter against the reference proteome personalized with germline variants, consisting of the
+    unchanged reference index plus the set of peptide windows created by germline variants and the set of
+    reference windows no haplotype of the patient contains anymore (homozygous germline variants)
+    """
+
+    def __init__(self, reference_db, added, removed, altered):
+        self.reference_db = reference_db
+        self.added = added
+        self.removed = removed
+        # reference sequences of the proteins altered by homozygous germline variants (all isoforms)
+        self.altered = altered
+
+    def exists(self, seq):
+        seq = str(seq)
+        if seq in self.added:
+            return True
+        if seq in self.removed:
+            # removed windows stay self if a reference protein not altered by the germline variants contains them
+            return any(p not in self.altered for p in self.reference_db.find_proteins(seq))
+        return self.reference_db.exists(seq)
+
+
+def collapse_identical_proteins(proteins):
+    """
+    groups mutated proteins with identical sequence and variant positions (isoforms translating to the same
+    mutated protein), only one representative per group has to be cut into peptides
+    :param proteins: mutated proteins
+    :return: representative proteins, dictionary representative transcript id: other proteins of the group
+    """
+    representatives = {}
+    isoforms = defaultdict(list)
+    collapsed = []
+    for p in proteins:
+        variants = ';'.join(['{}:{}'.format(pos, ','.join(sorted(['{}:{}:{}>{}'.format(v.chrom, v.genomePos, v.ref, v.obs) for v in vs])))
+                             for pos, vs in sorted(p.vars.items())])
+        key = hashlib.md5('{}|{}'.format(str(p), variants).encode('ascii')).digest()
+        if key in representatives:
+            isoforms[representatives[key].transcript_id].append(p)
+        else:
+            representatives[key] = p
+            collapsed.append(p)
+    logging.info("Collapsed {} mutated proteins into {} distinct ones".format(len(proteins), len(collapsed)))
+    return collapsed, isoforms
+
+
+def add_isoform_provenance(peptides, isoforms):
+    # peptides of a representative occur at the same positions in all proteins collapsed into it
+    for pep in peptides:
+        for transcript_id in list(pep.proteins.keys()):
+            for p in isoforms.get(transcript_id, []):
+                pep.proteins[p.transcript_id] = p
+                pep.proteinPos[p.transcript_id] = list(pep.proteinPos[transcript_id])
+    return peptides
+
+
+# coding indels in HGVS notation, e.g. c.123delA, c.123_124insT, c.123dupA, c.123_125delinsGT
+HGVS_INDEL_PATTERN = re.compile(r"^c\.(\d+)(?:_(\d+))?(delins|del|ins|dup)([ACGTacgt]*)$")
+
+
+class NeoORF(object):
+    """
+    mutated protein of a frameshift on one transcript: the wild-type prefix up to the first changed amino acid
+    (junction) followed by the novel tail up to the first stop codon
+    """
+
+    def __init__(self, transcript_id, variant, protein, wt_protein, junction, cds_length):
+        self.transcript_id = transcript_id
+        self.variant = variant
+        self.protein = protein
+        self.wt_protein = wt_protein
+        self.junction = junction
+        self.cds_length = cds_length
+        # only the frameshift is annotated, not every position of the tail
+        self.vars = {junction: [variant]}
+
+    def __len__(self):
+        return self.cds_length
+
+
+class NeoORFPeptide(Peptide):
+    """
+    peptide window of one or more neo-ORFs, implements the parts of the FRED2 peptide interface used for the
+    result columns with one (neo-ORF, start) origin per transcript instead of per-position variant maps
+    """
+
+    def __init__(self, seq):
+        Peptide.__init__(self, seq)
+        self.origins = {}
+        # no wild-type counterpart in any of its origins
+        self.novel = True
+
+    def add_origin(self, orf, start):
+        self.origins[orf.transcript_id] = (orf, start)
+        self.novel = self.novel and start >= orf.junction
+
+    def get_all_transcripts(self):
+        return [orf for orf, start in self.origins.itervalues()]
+
+    def get_variants_by_protein(self, transcript_id):
+        return [self.origins[transcript_id][0].variant]
+
+    def get_wt_sequence(self, transcript_id):
+        orf, start = self.origins[transcript_id]
+        if start >= orf.junction or start + len(self) > len(orf.wt_protein):
+            return None
+        return orf.wt_protein[start:start + len(self)]
+
+
+def _translate_to_stop(seq):
+    return str(translate(seq[:len(seq) - len(seq) % 3], to_stop=True))
+
+
+def apply_cds_indel(cds, syntax):
+    """
+    applies a coding indel given in HGVS notation to the coding sequence
+    :return: mutated coding sequence and first changed position, None for unsupported notations
+    """
+    m = HGVS_INDEL_PATTERN.match(syntax)
+    if m is None:
+        return None
+    op, seq = m.group(3), m.group(4).upper()
+    start = int(m.group(1)) - 1
+    if m.group(2):
+        end = int(m.group(2))
+    elif op in ('del', 'dup'):
+        end = start + max(len(seq), 1)
+    else:
+        end = start + 1
+    if end > len(cds):
+        return None
+    if op == 'del':
+        return cds[:start] + cds[end:], start
+    elif op == 'dup':
+        return cds[:end] + cds[start:end] + cds[end:], end
+    elif not seq:
+        return None
+    elif op == 'ins':
+        return cds[:start + 1] + seq + cds[start + 1:], start + 1
+    return cds[:start] + seq + cds[end:], start
+
+
+def create_neo_orf(transcript_id, variant, cds):
+    """
+    translates the neo-ORF of a frameshift once, from the affected codon up to the first stop codon
+    :return: NeoORF, None if the frameshift cannot be applied or yields no novel amino acids
+    """
+    applied = apply_cds_indel(cds, variant.coding[transcript_id].cdsMutationSyntax)
+    if applied is None or (len(applied[0]) - len(cds)) % 3 == 0:
+        return None
+    mut_cds, pos = applied
+    codon_start = pos - pos % 3
+    wt_protein = _translate_to_stop(cds)
+    protein = wt_protein[:codon_start // 3] + _translate_to_stop(mut_cds[codon_start:])
+    junction = next((i for i in xrange(codon_start // 3, len(protein)) if i >= len(wt_protein) or protein[i] != wt_protein[i]), None)
+    if junction is None:
+        return None
+    return NeoORF('{}:{}'.format(transcript_id, variant.genomePos), variant, protein, wt_protein, junction, len(cds))
+
+
+def generate_neo_orf_peptides(variants, martsadapter, lengths):
+    """
+    frameshift path of the peptide generation: each neo-ORF is translated once and windowed for all lengths,
+    windows shared by overlapping frameshifts are created once
+    :param variants: list of FRED2 frameshift variants
+    :param martsadapter: MartsAdapter for the coding sequences
+    :param lengths: peptide lengths
+    :return: dictionary length: list of NeoORFPeptides, dictionary id(variant): variant restricted to the
+             transcripts no neo-ORF could be created for
+    """
+    cds_cache = {}
+    peptides = {}
+    unresolved = {}
+    for v in variants:
+        orfs = []
+        failed = []
+        for transcript_id in v.coding:
+            if transcript_id not in cds_cache:
+                cds_cache[transcript_id] = martsadapter.get_transcript_sequence(transcript_id, type=ID_SYSTEM_USED)
+            cds = cds_cache[transcript_id]
+            orf = create_neo_orf(transcript_id, v, str(cds).upper()) if cds else None
+            if orf is not None:
+                orfs.append(orf)
+            else:
+                failed.append(transcript_id)
+        if failed:
+            logging.warning("No neo-ORF for frameshift {}:{} on {}, left to the standard path".format(v.chrom, v.genomePos, ','.join(failed)))
+            if orfs:
+                # the variant is handed to FRED2 with the failed transcripts only, metadata is shared
+                v_rest = copy.copy(v)
+                v_rest.coding = dict((t, v.coding[t]) for t in failed)
+                unresolved[id(v)] = v_rest
+            else:
+                unresolved[id(v)] = v
+        for orf in orfs:
+            for l in lengths:
+                # windows ending before the junction are wild-type
+                for start in xrange(max(0, orf.junction - l + 1), len(orf.protein) - l + 1):
+                    seq = orf.protein[start:start + l]
+                    if 'X' in seq:
+                        continue
+                    if seq not in peptides:
+                        peptides[seq] = NeoORFPeptide(seq)
+                    peptides[seq].add_origin(orf, start)
+
+    peptides_by_length = defaultdict(list)
+    for seq, p in peptides.iteritems():
+        peptides_by_length[len(seq)].append(p)
+    logging.info("Frameshifts: {} variants, {} neo-ORF peptides, {} variants left to the standard path".format(len(variants), len(peptides), len(unresolved)))
+    return peptides_by_length, unresolved
+
+
+def build_germline_delta(filename, martsadapter, lengths):
+    """
+    applies germline variants to the reference protein sequences, collects all peptide windows covering a
+    germline variant and all reference windows of the affected transcripts that none of the patient's
+    protein variants contains anymore (destroyed by homozygous germline variants)
+    :param filename: /path/to/germline variants (vcf, GSvar or tsv)
+    :param martsadapter: MartsAdapter to retrieve transcript sequences
+    :param lengths: peptide lengths
+    :return: set of added peptide sequences, set of removed peptide sequences, set of reference sequences of the
+             proteins the removed windows were taken from
+    """
+    if filename.endswith('.vcf'):
+        germline_vars, transcripts = read_vcf(filename)
+    else:
+        germline_vars, transcripts, metadata = read_GSvar(filename)
+
+    prots = [p for p in generator.generate_proteins_from_transcripts(generator.generate_transcripts_from_variants(germline_vars, martsadapter, ID_SYSTEM_USED))]
+
+    # all windows of the patient's protein variants of transcripts with homozygous germline variants
+    homozygous_transcripts = set([t for v in germline_vars if v.isHomozygous for t in v.coding])
+    patient_windows = defaultdict(set)
+    for p in prots:
+        transcript_id = p.transcript_id.split(':')[0]
+        if transcript_id in homozygous_transcripts:
+            seq = str(p)
+            patient_windows[transcript_id].update([seq[i:i + l] for l in lengths for i in xrange(len(seq) - l + 1)])
+
+    prots, isoforms = collapse_identical_proteins(prots)
+    added = set()
+    for peplen in lengths:
+        for x in generator.generate_peptides_from_proteins(prots, peplen):
+            if any(x.get_variants_by_protein(y) for y in x.proteins.keys()):
+                added.add(str(x))
+
+    removed = set()
+    altered = set()
+    for transcript_id in homozygous_transcripts:
+        cds = martsadapter.get_transcript_sequence(transcript_id, type=ID_SYSTEM_USED)
+        if not cds or transcript_id not in patient_windows:
+            continue
+        wt_protein = _translate_to_stop(str(cds).upper())
+        altered.add(wt_protein)
+        removed.update([wt_protein[i:i + l] for l in lengths for i in xrange(len(wt_protein) - l + 1)
+                        if wt_protein[i:i + l] not in patient_windows[transcript_id]])
+    removed -= added
+    logging.info("Germline variants: {} variants, {} added and {} removed peptide windows".format(len(germline_vars), len(added), len(removed)))
+    return added, removed, altered
+
+
+def write_germline_delta(added, removed, altered, filename):
+    with atomic_output(filename, 'w') as out:
+        out.write('sequence\tchange\n')
+        for seq in sorted(added):
+            out.write('{}\tadded\n'.format(seq))
+        for seq in sorted(removed):
+            out.write('{}\tremoved\n'.format(seq))
+        for seq in sorted(altered):
+            out.write('{}\taltered\n'.format(seq))
+
+
+def read_germline_delta(filename):
+    """
+    reads a germline delta written by 'epaa.py parse'
+    :return: set of added peptide sequences, set of removed peptide sequences, set of altered protein sequences
+    """
+    delta = {'added': set(), 'removed': set(), 'altered': set()}
+    with open(filename, 'r') as inp:
+        for row in csv.DictReader(inp, delimiter='\t'):
+            delta[row['change']].add(row['sequence'])
+    return delta['added'], delta['removed'], delta['altered']
+
+
+def create_variant_manifest(variants, metadata=[]):
+    """
+    creates the variant manifest of a run, used to detect changes between two runs of the same sample
+    :param variants: list of FRED2 variants
+    :param metadata: metadata labels (e.g. allele frequencies and read depths) that are part of the signatures
+    :return: dictionary transcript id -> set of variant signatures
+    """
+    manifest = defaultdict(set)
+    for v in variants:
+        # zygosity and metadata are written to the results and change them as well
+        values = ['{}={}'.format(m, v.get_metadata(m)[0] if v.get_metadata(m) else '') for m in sorted(metadata)]
+        for trans_id, syntax in v.coding.iteritems():
+            manifest[trans_id].add('|'.join(['{}:{}:{}>{}'.format(v.chrom, v.genomePos, v.ref, v.obs), str(v.type), syntax.cdsMutationSyntax,
+                                             syntax.aaMutationSyntax, 'hom={}'.format(v.isHomozygous)] + values))
+    return manifest
+
+
+def write_variant_manifest(manifest, filename):
+    with open(filename, 'w') as out:
+        out.write('transcript\tvariant\n')
+        for trans_id in sorted(manifest):
+            for signature in sorted(manifest[trans_id]):
+                out.write('{}\t{}\n'.format(trans_id, signature))
+
+
+def read_variant_manifest(filename, sample=None):
+    """
+    reads a variant manifest, manifests merged by 'epaa.py merge' have a sample column and only the rows of the
+    given sample are read
+    """
+    manifest = defaultdict(set)
+    with open(filename, 'r') as inp:
+        reader = csv.DictReader(inp, delimiter='\t')
+        for row in reader:
+            if sample is not None and row.get('sample', sample) != sample:
+                continue
+            manifest[row['transcript']].add(row['variant'])
+    return manifest
+
+
+def get_affected_transcripts(previous_manifest, manifest):
+    """
+    diffs two variant manifests on transcript level
+    :param previous_manifest: manifest of the previous run
+    :param manifest: manifest of the current run
+    :return: set of transcript ids with added, removed or changed variants
+    """
+    all_transcripts = set(previous_manifest.keys()) | set(manifest.keys())
+    return set([t for t in all_transcripts if previous_manifest.get(t, set()) != manifest.get(t, set())])
+
+
+def expand_affected_transcripts(previous_df, affected):
+    """
+    extends the set of affected transcripts by all transcripts sharing a result row with an affected one,
+    so that rows with mixed provenance are regenerated completely
+    """
+    if previous_df.empty or 'transcripts' not in previous_df.columns:
+        return set(affected)
+    affected = set(affected)
+    row_transcripts = [set(str(t).split(',')) for t in previous_df['transcripts'].dropna().unique()]
+    changed = True
+    while changed:
+        changed = False
+        for ts in row_transcripts:
+            if ts & affected and not ts <= affected:
+                affected |= ts
+                changed = True
+    return affected
+
+
+def restrict_variants_to_transcripts(variants, transcripts, metadata):
+    """
+    keeps only variants located on the given transcripts and drops annotations on all other transcripts
+    :param variants: list of FRED2 variants
+    :param transcripts: set of transcript ids
+    :param metadata: list of metadata labels to keep
+    :return: list of FRED2 variants
+    """
+    restricted = []
+    for v in variants:
+        coding = dict((t, s) for t, s in v.coding.iteritems() if t in transcripts)
+        if not coding:
+            continue
+        v_new = Variant(v.id, v.type, v.chrom, v.genomePos, v.ref, v.obs, coding, v.isHomozygous, v.isSynonymous)
+        v_new.gene = v.gene
+        for m in metadata:
+            values = v.get_metadata(m)
+            if values:
+                v_new.log_metadata(m, values[0])
+        restricted.append(v_new)
+    return restricted
+
+
+def _get_float_metadata(variant, label):
+    values = variant.get_metadata(label)
+    try:
+        return float(values[0])
+    except (IndexError, TypeError, ValueError):
+        return None
+
+
+def prune_variants_by_frequency(variants, min_values):
+    """
+    drops variants below the minimal tumor/RNA allele frequencies and read depths, variants without the
+    corresponding metadata (e.g. VCF input) are kept
+    :param variants: list of FRED2 variants
+    :param min_values: dictionary metadata label: minimal value, e.g. {'tumor_af': 0.05}
+    :return: list of FRED2 variants, number of pruned variants
+    """
+    min_values = dict([(m, v) for m, v in min_values.iteritems() if v is not None])
+    kept = []
+    for v in variants:
+        values = [(_get_float_metadata(v, m), min_value) for m, min_value in min_values.iteritems()]
+        if all(value is None or value >= min_value for value, min_value in values):
+            kept.append(v)
+    logging.info("Pruned {} of {} variants by allele frequency and read depth".format(len(variants) - len(kept), len(variants)))
+    return kept, len(variants) - len(kept)
+
+
+def read_gene_expression(filename, gene_index):
+    """
+    reads HTSeq gene counts and normalizes them to RPKM with the gene lengths of the gene index, genes not in the
+    index are skipped
+    """
+    values = read_diff_expression_values(filename)
+    counts = dict([(g, float(v)) for g, v in values.iteritems() if not g.startswith('__') and gene_index.length(g) is not None])
+    total_counts = sum(counts.values())
+    if total_counts == 0:
+        return {}
+    return dict([(g, 10.0**9 * c / (gene_index.length(g) * total_counts)) for g, c in counts.iteritems()])
+
+
+def prune_variants_by_expression(variants, expression, min_expression, gene_index):
+    """
+    drops variants in genes expressed below the cutoff, variants in genes without expression value are kept
+    :param variants: list of FRED2 variants
+    :param expression: dictionary gene: normalized expression
+    :param min_expression: minimal expression (RPKM)
+    :param gene_index: GeneIndex to map between Ensembl ids and HGNC symbols
+    :return: list of FRED2 variants, number of pruned variants
+    """
+    feature_map = map_genes_to_features([v.gene for v in variants], gene_index, resolve_gene_id_system(expression.keys()))
+    kept = []
+    for v in variants:
+        genes = [feature_map.get(g, g) for g in str(v.gene).split(',') if g]
+        values = [expression[g] for g in genes if g in expression]
+        if not values or max(values) >= min_expression:
+            kept.append(v)
+    logging.info("Pruned {} of {} variants by gene expression".format(len(variants) - len(kept), len(variants)))
+    return kept, len(variants) - len(kept)
+
+
+# comma separated provenance columns of result rows, a sequence is reported in one row per method with all its provenances
+PROVENANCE_COLUMNS = ['chr', 'pos', 'gene', 'transcripts', 'proteins', 'variant type', 'synonymous', 'homozygous',
+                      'variant details (genomic)', 'variant details (protein)', 'wt sequence']
+
+
+def _join_provenance(values):
+    return ','.join(sorted(set([x for v in values if pd.notnull(v) for x in str(v).split(',') if x])))
 
-    for peplen in sorted_peptides:
-        all_peptides_filtered = sorted_peptides[peplen]
-        results = []
-        for m in methods:
+
+def patch_prediction_results(previous_df, df, affected, metadata=[]):
+    """
+    replaces all rows of the previous results that originate from affected transcripts with the new predictions.
+    Unaffected rows with the sequence of a new prediction are merged into the new row (as in a complete run), their
+    scores only depend on the sequence and are not predicted again; other annotations are taken from the new row
+    :param previous_df: dataframe with the previous prediction results
+    :param df: dataframe with the predictions for the affected transcripts
+    :param affected: set of affected transcript ids
+    :param metadata: metadata columns merged like the provenance columns
+    :return: patched dataframe, stable sorted by sequence and method
+    """
+    if not previous_df.empty:
+        keep = previous_df['transcripts'].map(lambda x: not set(str(x).split(',')) & affected)
+        previous_df = previous_df[keep]
+        keys = zip(df['sequence'], df['method']) if not df.empty else []
+        new_keys = set(keys)
+        shared = np.array([k in new_keys for k in zip(previous_df['sequence'], previous_df['method'])], dtype=bool)
+        if shared.any():
+            previous_rows = defaultdict(list)
+            for i, r in previous_df[shared].iterrows():
+                previous_rows[(r['sequence'], r['method'])].append(r)
+            df = df.copy()
+            for c in [c for c in PROVENANCE_COLUMNS + metadata if c in df.columns and c in previous_df.columns]:
+                df[c] = [_join_provenance([v] + [r[c] for r in previous_rows[k]]) if k in previous_rows else v for v, k in zip(df[c], keys)]
+            if 'novel' in df.columns and 'novel' in previous_df.columns:
+                df['novel'] = [v and all([r['novel'] for r in previous_rows[k]]) for v, k in zip(df['novel'], keys)]
+            previous_df = previous_df[~shared]
+    patched = pd.concat([previous_df, df], ignore_index=True)
+    if patched.empty:
+        return patched
+    patched = patched.reindex(columns=[c for c in previous_df.columns] + [c for c in df.columns if c not in previous_df.columns])
+    return patched.sort_values(by=['sequence', 'method', 'transcripts'], kind='mergesort').reset_index(drop=True)
+
+
+def get_wt_peptides(peptides, wt_reconstructor):
+    """
+    derives the wild-type sequences of mutated peptides
+    :param peptides: list of FRED2 peptides
+    :param wt_reconstructor: WildTypeReconstructor shared by all lengths
+    :return: dictionary mutant sequence -> sorted list of wild-type sequences (one per transcript)
+    """
+    wt_for_peptide = defaultdict(set)
+    for p in peptides:
+        for t in p.get_all_transcripts():
+            if not t.vars:
+                continue
+            wt = wt_reconstructor.get(p, t.transcript_id)
+            if wt is not None and not pd.isnull(wt):
+                wt_for_peptide[str(p)].add(wt)
+    return dict((k, sorted(v)) for k, v in wt_for_peptide.iteritems())
+
+
+def update_wt_score_lookup(scores, df, wt_sequences):
+    # (method, allele, sequence) -> score of all predicted sequences that are wild-types of mutated peptides
+    for c in df.columns:
+        for idx, score in df[c].iteritems():
+            if str(idx[0]) in wt_sequences:
+                scores[(idx[1], str(c), str(idx[0]))] = score
+
+
+def _join_wt_values(values):
+    # one value per wild-type, in the order of the wt sequence column
+    if len(values) == 1:
+        return values[0]
+    return ','.join(['' if pd.isnull(v) else str(v) for v in values]) if values else np.nan
+
+
+def add_wt_prediction_columns(df, alleles, wt_for_peptide, wt_scores, max_values_matrices, allele_string_map):
+    """
+    adds wild-type score, affinity and mutant/wild-type affinity ratio columns, a peptide with several wild-types
+    (different transcripts) gets comma separated values for all of them
+    """
+    wts = df['Seq'].map(lambda x: wt_for_peptide.get(str(x), []))
+    for a in alleles:
+        if '%s affinity' % a not in df.columns:
+            continue
+        wt_score = []
+        wt_affinity = []
+        ratio = []
+        for l, m, affinity, seqs in zip(df['length'], df['Method'], df['%s affinity' % a], wts):
+            scores = [wt_scores.get((m, str(a), wt), np.nan) for wt in seqs]
+            affinities = [create_affinity_values(str(a), int(l), float(sc), m, max_values_matrices, allele_string_map) for sc in scores]
+            wt_score.append(_join_wt_values([round(sc, 4) for sc in scores]))
+            wt_affinity.append(_join_wt_values(affinities))
+            ratio.append(_join_wt_values([round(float(affinity) / float(wt_aff), 4) if wt_aff else np.nan for wt_aff in affinities]))
+        idx = df.columns.get_loc('%s binder' % a)
+        df.insert(idx + 1, '%s wt score' % a, wt_score)
+        df.insert(idx + 2, '%s wt affinity' % a, wt_affinity)
+        df.insert(idx + 3, '%s mutant/wt ratio' % a, ratio)
+    return df
+
+
+class BackgroundScores(object):
+    """
+    background score distributions of a fixed random set of natural peptides (windows of the reference proteome),
+    scored once per (method, allele, length) and cached as sorted arrays next to the proteome cache. Later runs
+    rank their predictions against the cached arrays without additional predictor calls.
+    """
+    AMINO_ACIDS = frozenset('ACDEFGHIKLMNPQRSTVWY')
+
+    def __init__(self, db, size=10000, seed=1):
+        self.db = db
+        self.size = size
+        self.seed = seed
+        self.arrays = {}
+
+    def _cache_file(self, method, allele, length):
+        return '{}.background_{}_{}_{}_{}_{}.npy'.format(self.db.blob_file, method, re.sub('[^A-Za-z0-9]', '_', allele), length, self.size, self.seed)
+
+    def sample_peptides(self, length):
+        """
+        draws the random peptides of a length, the same for every run on the same proteome
+        """
+        rng = np.random.RandomState(self.seed + length)
+        sequences = set()
+        for attempt in xrange(20):
+            for start in rng.randint(0, max(len(self.db.blob) - length, 1), size=2 * self.size):
+                seq = self.db.blob[start:start + length].decode('ascii')
+                if len(seq) == length and self.AMINO_ACIDS.issuperset(seq):
+                    sequences.add(seq)
+                    if len(sequences) == self.size:
+                        return [Peptide(seq) for seq in sorted(sequences)]
+        if not sequences:
+            raise ValueError("No background peptides of length {length} in the reference proteome {proteome}".format(length=length, proteome=self.db.blob_file))
+        return [Peptide(seq) for seq in sorted(sequences)]
+
+    def get(self, method, alleles, length):
+        """
+        :param method: method string
+        :param alleles: list of FRED2 alleles, missing distributions are scored in one predictor call
+        :return: dictionary allele string: sorted background scores (None if the method does not support the allele)
+        """
+        missing = []
+        for a in alleles:
+            key = (method, str(a), length)
+            if key not in self.arrays:
+                cache_file = self._cache_file(method, str(a), length)
+                if os.path.exists(cache_file):
+                    self.arrays[key] = np.load(cache_file, mmap_mode='r')
+                else:
+                    missing.append(a)
+
+        if missing:
+            logging.info("Scoring background peptides of length {} with {} for {}".format(length, method, ','.join([str(a) for a in missing])))
+            peptides = self.sample_peptides(length)
             try:
-                results.extend([EpitopePredictorFactory(m.split('-')[0], version=m.split('-')[1]).predict(all_peptides_filtered, alleles=alleles)])
-            except:
-                logging.warning("Prediction for length {length} and allele {allele} not possible with {method}. No model available.".format(length=peplen, allele=','.join([str(a) for a in alleles]), method=m))
+                df = predict_peptides(method, peptides, missing)
+            except ValueError as e:
+                # raised by the predictors if none of the alleles (and lengths) is supported
+                logging.warning("Background scores for length {length} and allele {allele} not possible with {method}: {error}".format(length=length, allele=','.join([str(a) for a in missing]), method=method, error=e))
+                df = pd.DataFrame()
+            columns = dict((str(c), c) for c in df.columns)
+            for a in missing:
+                key = (method, str(a), length)
+                if str(a) not in columns:
+                    self.arrays[key] = None
+                    continue
+                scores = df[columns[str(a)]].values.astype(float)
+                self.arrays[key] = np.sort(scores[~np.isnan(scores)]).astype(np.float32)
+                # concurrent runs must not see partial caches
+                with atomic_output(self._cache_file(method, str(a), length)) as out:
+                    np.save(out, self.arrays[key])
+
+        return dict((str(a), self.arrays[(method, str(a), length)]) for a in alleles)
+
+
+def add_rank_columns(df, background, methods, alleles, peplen):
+    """
+    adds a %rank column per allele, the percentage of background peptides of the same method, allele and length
+    scoring at least as high (lower is better, comparable across alleles)
+    """
+    method_map = dict((m.split('-')[0], m) for m in methods)
+    for a in alleles:
+        if '%s score' % a not in df.columns:
+            continue
+        ranks = np.full(df.shape[0], np.nan)
+        for name in df['Method'].unique():
+            bg = background.get(method_map.get(name, name), alleles, peplen)[str(a)]
+            if bg is None or len(bg) == 0:
+                continue
+            mask = (df['Method'] == name).values
+            scores = df['%s score' % a].values[mask].astype(float)
+            with np.errstate(invalid='ignore'):
+                ranks[mask] = np.where(np.isnan(scores), np.nan, np.round(100.0 * (len(bg) - np.searchsorted(bg, scores, side='left')) / len(bg), 2))
+        last = '%s mutant/wt ratio' % a if '%s mutant/wt ratio' % a in df.columns else '%s binder' % a
+        df.insert(df.columns.get_loc(last) + 1, '%s %%rank' % a, ranks)
+    return df
+
+
+def estimate_variant_peptides(n_transcript_variants, minlength, maxlength):
+    # a missense variant yields one peptide per length and covering position in each affected transcript
+    return sum([l * n_transcript_variants for l in range(minlength, maxlength)])
+
+
+def plan_resources(n_peptides, n_proteins, n_alleles, methods, max_memory=None, threads=1):
+    """
+    estimates peak memory (MB) and runtime (s) of the predictions and picks the peptide chunk size and number
+    of external predictor workers fitting into the given budget
+    :param n_peptides: (estimated) number of peptides
+    :param n_proteins: number of proteins generated from the variants
+    :param n_alleles: number of alleles
+    :param methods: prediction methods
+    :param max_memory: memory budget in MB, None for no limit
+    :param threads: maximal number of external predictor workers
+    :return: dictionary with the estimates, chunk size and number of workers
+    """
+    n_external = len([m for m in methods if m in EXTERNAL_METHODS])
+
+    # memory held during the whole run: proteins, peptides and the result tables of all lengths (and their concatenation)
+    fixed_memory = COST_MODEL['base_memory'] + n_proteins * COST_MODEL['protein_memory'] + n_peptides * COST_MODEL['peptide_memory'] \
+        + 2 * n_peptides * len(methods) * n_alleles * COST_MODEL['prediction_memory']
+    # memory per peptide of a chunk while it is predicted and annotated
+    chunk_memory = len(methods) * n_alleles * COST_MODEL['prediction_memory'] * COST_MODEL['annotation_copies']
+
+    workers = max(1, threads) if n_external > 0 else 1
+    chunk_size = None
+    if max_memory is not None:
+        available = max_memory - fixed_memory
+        if n_external > 0:
+            # at most half of the remaining memory is used for external predictor processes
+            workers = max(1, min(workers, int(available / 2 / COST_MODEL['worker_memory'])))
+        available -= workers * COST_MODEL['worker_memory']
+        chunk_size = max(1000, int(available / chunk_memory)) if available > 0 else 1000
+        if available <= 0:
+            logging.warning("Estimated memory of {} MB exceeds the budget of {} MB.".format(int(max_memory - available), max_memory))
+        if chunk_size >= n_peptides:
+            chunk_size = None
+
+    peptides_per_chunk = chunk_size or max(n_peptides, 1)
+    n_chunks = int(math.ceil(n_peptides / float(peptides_per_chunk)))
+    memory = fixed_memory + workers * COST_MODEL['worker_memory'] * (n_external > 0) + peptides_per_chunk * chunk_memory
+    runtime = n_peptides * COST_MODEL['peptide_runtime'] \
+        + n_peptides * n_alleles * len(methods) * COST_MODEL['prediction_runtime'] / workers \
+        + n_chunks * n_external * COST_MODEL['startup_runtime']
+
+    return {'peptides': n_peptides, 'proteins': n_proteins, 'alleles': n_alleles, 'memory_mb': int(math.ceil(memory)),
+            'runtime_s': int(math.ceil(runtime)), 'threads': workers, 'chunk_size': chunk_size}
+
+
+def write_resource_estimate(plan, filename):
+    with open(filename, 'w') as out:
+        json.dump(plan, out, indent=2, sort_keys=True)
+
+
+class DroppedPredictions(object):
+    """
+    aggregate counts of the prediction rows dropped by the output filter, merged into the report statistics
+    """
+
+    def __init__(self):
+        self.predictions = 0
+        self.binders = 0
+        self.allele_binders = Counter()
+        self.method_binders = Counter()
+        self.sequences = set()
+        self.binder_sequences = set()
+
+    def add(self, sequences, methods, binder_values, alleles):
+        """
+        :param sequences: peptide sequences of the dropped rows
+        :param methods: methods of the dropped rows
+        :param binder_values: boolean matrix rows x alleles
+        :param alleles: allele names of the binder matrix columns
+        """
+        is_binder = binder_values.any(axis=1)
+        self.predictions += len(sequences)
+        self.binders += int(is_binder.sum())
+        for a, n in zip(alleles, binder_values.sum(axis=0)):
+            self.allele_binders[a] += int(n)
+        for m, b, seq in zip(methods, is_binder, sequences):
+            self.method_binders[m] += int(b)
+            self.sequences.add(seq)
+            if b:
+                self.binder_sequences.add(seq)
+
+    def rename_methods(self, method_map):
+        renamed = Counter()
+        for m, n in self.method_binders.iteritems():
+            renamed[method_map.get(m, m)] += n
+        self.method_binders = renamed
+
+
+class TopKSelector(object):
+    """
+    bounded top-K of the prediction rows per group (variant, allele or sample, always per method) in min-heaps,
+    rows are offered while the predictions come in, rows evicted later are removed by select_top_k_rows
+    """
+
+    def __init__(self, k, by):
+        self.k = k
+        self.by = by
+        self.heaps = defaultdict(list)
+        self.counter = itertools.count()
+
+    def _push(self, group, score, row):
+        heap = self.heaps[group]
+        if len(heap) < self.k:
+            heapq.heappush(heap, (score, next(self.counter), row))
+            return True
+        if score > heap[0][0]:
+            heapq.heapreplace(heap, (score, next(self.counter), row))
+            return True
+        return False
+
+    def offer(self, index, scores, alleles):
+        """
+        :param index: (peptide, method) index of the prediction rows
+        :param scores: normalized scores, rows x alleles (higher is better)
+        :param alleles: allele names of the score columns
+        :return: boolean array of the rows currently among the top-K of one of their groups
+        """
+        keep = np.zeros(len(index), dtype=bool)
+        for i, (pep, m) in enumerate(index):
+            row = (str(pep), m)
+            if self.by == 'allele':
+                groups = [((m, a), sc) for a, sc in zip(alleles, scores[i]) if not np.isnan(sc)]
+            else:
+                best = np.nanmax(scores[i]) if not np.isnan(scores[i]).all() else np.nan
+                if np.isnan(best):
+                    continue
+                if self.by == 'variant':
+                    variants = set([(v.chrom, v.genomePos, v.ref, v.obs) for t in pep.get_all_transcripts() for v in pep.get_variants_by_protein(t.transcript_id)])
+                    groups = [((m, v), best) for v in variants]
+                else:
+                    groups = [((m,), best)]
+            for group, sc in groups:
+                keep[i] |= self._push(group, sc, row)
+        return keep
+
+    def retained(self):
+        return set([row for heap in self.heaps.itervalues() for score, c, row in heap])
+
+
+def score_prediction_rows(df, peplen, max_values_matrices, allele_string_map):
+    """
+    normalized scores (netMHC scores, Syfpeithi scores relative to the max score of the allele) and binder
+    flags of raw prediction rows, using the same rules as create_affinity_values and create_binder_values
+    :return: score matrix, binder matrix, pass matrix of the threshold filter (rows x alleles)
+    """
+    is_syf = np.array(['syf' in m for m in df.index.get_level_values(1)], dtype=bool)[:, None]
+    raw = df.values.astype(float)
+    max_scores = np.array([max_values_matrices.get(allele_string_map.get('%s_%s' % (str(c), peplen)), np.nan) for c in df.columns], dtype=float)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        relative = raw / max_scores * 100.0
+        affinity = 50000 ** (1.0 - raw)
+        scores = np.where(is_syf, relative / 100.0, raw)
+        binders = np.where(is_syf, relative > 50.0, affinity <= 500.0)
+        passes = np.where(is_syf, relative > OUTPUT_FILTER['syfpeithi_threshold'], affinity <= OUTPUT_FILTER['affinity_threshold'])
+    return scores, binders & ~np.isnan(raw), passes & ~np.isnan(raw)
+
+
+def filter_prediction_rows(df, peplen, max_values_matrices, allele_string_map, dropped, selector):
+    """
+    output filter of raw prediction rows, only retained rows are annotated
+    """
+    scores, binders, passes = score_prediction_rows(df, peplen, max_values_matrices, allele_string_map)
+    alleles = [str(c) for c in df.columns]
+    if OUTPUT_FILTER['mode'] == 'threshold':
+        keep = passes.any(axis=1)
+    else:
+        keep = selector.offer(df.index, scores, alleles)
+    dropped.add([str(p) for p in df.index.get_level_values(0)[~keep]], df.index.get_level_values(1)[~keep], binders[~keep], alleles)
+    return df[keep]
+
+
+def select_top_k_rows(rows_by_length, selector, dropped, max_values_matrices, allele_string_map):
+    """
+    selection of the top-K mode, removes raw prediction rows evicted from the heaps after they were retained
+    :param rows_by_length: dictionary length: list of raw prediction rows retained when offered
+    :return: dictionary length: list with the raw prediction rows currently in the heaps
+    """
+    retained = selector.retained()
+    selected = {}
+    for peplen, frames in rows_by_length.iteritems():
+        df = pd.concat(frames) if len(frames) > 1 else frames[0]
+        keep = np.array([(str(pep), m) in retained for pep, m in df.index], dtype=bool)
+        if not keep.all():
+            scores, binders, passes = score_prediction_rows(df[~keep], peplen, max_values_matrices, allele_string_map)
+            dropped.add([str(p) for p in df.index.get_level_values(0)[~keep]], df.index.get_level_values(1)[~keep], binders, [str(c) for c in df.columns])
+        if keep.any():
+            selected[peplen] = [df[keep]]
+    return selected
+
+
+def annotate_variant_predictions(df, peplen, methods, alleles, metadata, max_values_matrices, allele_string_map, wt_for_peptide=None, wt_scores=None):
+    """
+    adds the variant, allele value (score, affinity, binder), wild-type, %rank and metadata columns to the
+    predictions of one peptide length
+    :param df: merged prediction results indexed by StoredPeptide and method
+    :param wt_for_peptide: wild-type sequences per mutated sequence, None without wild-type columns
+    :param wt_scores: scores of the wild-type predictions, None without wild-type predictions
+    :return: dataframe with one row per peptide and method
+    """
+    df.insert(0, 'length', df.index.map(create_length_column_value))
+    df['chr'] = df.index.map(create_variant_chr_column_value)
+    df['pos'] = df.index.map(create_variant_pos_column_value)
+    df['gene'] = df.index.map(create_gene_column_value)
+    df['transcripts'] = df.index.map(create_transcript_column_value)
+    df['proteins'] = df.index.map(create_protein_column_value)
+    df['variant type'] = df.index.map(create_variant_type_column_value)
+    df['synonymous'] = df.index.map(create_variant_syn_column_value)
+    df['homozygous'] = df.index.map(create_variant_hom_column_value)
+    df['variant details (genomic)'] = df.index.map(create_mutationsyntax_genome_column_value)
+    df['variant details (protein)'] = df.index.map(create_mutationsyntax_column_value)
+    df['novel'] = df.index.map(create_novel_column_value)
+
+    # reset index to have index as columns
+    df.reset_index(inplace=True)
+
+    for c in df.columns:
+        if '*' in str(c):
+            idx = df.columns.get_loc(c)
+            df.insert(idx + 1, '%s affinity' % c, df.apply(lambda x: create_affinity_values(str(c), int(x['length']), float(x[c]), x['Method'], max_values_matrices, allele_string_map), axis=1))
+            df.insert(idx + 2, '%s binder' % c, df.apply(lambda x: create_binder_values(float(x['%s affinity' % c]), x['Method']), axis=1))
+            df = df.rename(columns={c: '%s score' % c})
+            df['%s score' % c] = df['%s score' % c].map(lambda x: round(x, 4))
+
+    if wt_for_peptide is not None:
+        df['wt sequence'] = df['Seq'].map(lambda x: ','.join(wt_for_peptide.get(str(x), [])) or np.nan)
+    if wt_scores is not None:
+        df = add_wt_prediction_columns(df, alleles, wt_for_peptide, wt_scores, max_values_matrices, allele_string_map)
+
+    if PERCENTILE_RANK['background'] is not None:
+        df = add_rank_columns(df, PERCENTILE_RANK['background'], methods, alleles, peplen)
+
+    for c in metadata:
+        df[c] = df.apply(lambda row: create_metadata_column_value(row, c), axis=1)
+
+    df = df.rename(columns={'Seq': 'sequence'})
+    df = df.rename(columns={'Method': 'method'})
+    return df
+
+
+def generate_filtered_peptides(prots, isoforms, neo_orf_peptides, protein_db, lengths, counts, wt_reconstructor=None, wt_for_peptide=None):
+    """
+    generates the variant relevant peptides of the mutated proteins and neo-ORFs one length at a time and removes
+    self peptides, FRED2 peptides only exist for the length being generated
+    :param counts: dictionary, 'peptides' counts the peptides before the self-filter
+    :param wt_reconstructor: WildTypeReconstructor, wild-types of the filtered peptides are added to wt_for_peptide
+    :return: generator of lists of filtered FRED2 peptides and NeoORFPeptides, one per length
+    """
+    for peplen in lengths:
+        peptide_gen = generator.generate_peptides_from_proteins(prots, peplen)
+
+        peptides_var = [x for x in peptide_gen]
+
+        # remove peptides which are not 'variant relevant'
+        peptides = [x for x in peptides_var if any(x.get_variants_by_protein(y) for y in x.proteins.keys())]
+
+        # all isoforms are listed in the transcripts/proteins columns
+        add_isoform_provenance(peptides, isoforms)
+
+        # neo-ORF windows not generated from other variants already
+        sequences = set([str(p) for p in peptides])
+        peptides.extend([p for p in neo_orf_peptides.pop(peplen, []) if str(p) not in sequences])
+
+        # filter out self peptides
+        selfies = set([str(p) for p in peptides if protein_db.exists(str(p))])
+        filtered_peptides = [p for p in peptides if str(p) not in selfies]
+        del peptides_var
+
+        counts['peptides'] += len(peptides)
+        if wt_reconstructor is not None:
+            wt_for_peptide.update(get_wt_peptides(filtered_peptides, wt_reconstructor))
+        del peptides
+        yield filtered_peptides
+
+
+def iter_peptide_chunks(store, peptide_batches, chunk_size):
+    """
+    packs the peptide batches into the store and yields chunks of StoredPeptides as soon as they are full, a chunk
+    spans the end of one length and the start of the next, the last partial chunk follows the last batch
+    :param store: PeptideStore
+    :param peptide_batches: iterable of lists of FRED2 peptides, e.g. generate_filtered_peptides
+    :param chunk_size: number of peptides per chunk, None for a single chunk of all peptides
+    """
+    start = 0
+    for batch in peptide_batches:
+        store.extend(batch)
+        while chunk_size and len(store) - start >= chunk_size:
+            yield store.peptides(start, start + chunk_size)
+            start += chunk_size
+    if len(store) > start:
+        yield store.peptides(start, len(store))
+
+
+def make_predictions_from_variants(variants_all, methods, alleles, minlength, maxlength, martsadapter, protein_db, identifier, metadata, transcriptProteinMap, wild_type=False, predict_wt=False):
+    # number of all peptides, compact store of the filtered peptides
+    counts = {'peptides': 0}
+    store = PeptideStore()
+
+    # wild-type sequences of the mutated peptides, reconstructed while their FRED2 peptides exist
+    wt_reconstructor = WildTypeReconstructor()
+    wt_for_peptide = {}
+
+    # dictionaries for syfpeithi matrices max values and allele mapping
+    max_values_matrices = {}
+    allele_string_map = {}
+
+    # list to hold dataframes for all predictions
+    pred_dataframes = []
+
+    # number of predictions pruned in cascade mode
+    skipped_predictions = 0
+
+    # rows dropped by the output filter, heaps of the top-K mode and the raw rows currently in them
+    dropped = DroppedPredictions()
+    selector = TopKSelector(OUTPUT_FILTER['k'], OUTPUT_FILTER['by'])
+    top_k_rows = defaultdict(list)
+
+    # frameshifts are handled by the neo-ORF engine, all other variants and frameshift transcripts without neo-ORF by FRED2
+    frameshifts = [v for v in variants_all if v.type in (VariationType.FSDEL, VariationType.FSINS)]
+    neo_orf_peptides, unresolved = generate_neo_orf_peptides(frameshifts, martsadapter, range(minlength, maxlength))
+    frameshift_ids = set([id(v) for v in frameshifts])
+    variants_fred2 = [unresolved.get(id(v)) if id(v) in frameshift_ids else v for v in variants_all]
+    variants_fred2 = [v for v in variants_fred2 if v is not None]
+
+    prots = [p for p in generator.generate_proteins_from_transcripts(generator.generate_transcripts_from_variants(variants_fred2, martsadapter, ID_SYSTEM_USED))]
+
+    # isoforms with identical mutated proteins are cut into peptides once
+    prots, isoforms = collapse_identical_proteins(prots)
+
+    peptide_batches = generate_filtered_peptides(prots, isoforms, neo_orf_peptides, protein_db, range(minlength, maxlength), counts,
+                                                 wt_reconstructor if wild_type or predict_wt else None, wt_for_peptide)
+
+    # wild-types of the mutated peptides generated so far, their scores are collected run-wide: a wild-type is
+    # predicted in the first chunk needing it, unless it is a mutated peptide of this or an earlier chunk
+    wt_scores = None
+    if predict_wt:
+        wt_sequences = set()
+        wt_scores = {}
+        scored_wt = set()
+        n_wt_indexed = 0
+
+    # chunks of filtered peptides, sized by the resource planner, are predicted as soon as they are generated, with
+    # one invocation per method for all lengths of the chunk, and annotated per length
+    for chunk in iter_peptide_chunks(store, peptide_batches, RESOURCE_PLAN['chunk_size']):
+        chunk_sequences = set([str(p) for p in chunk])
+
+        # wild-type peptides are predicted in the same calls as the mutated ones
+        wt_peptides = []
+        if predict_wt:
+            for i in xrange(n_wt_indexed, len(store)):
+                wt_sequences.update(wt_for_peptide.get(store.sequence(i), []))
+            n_wt_indexed = len(store)
+            needed = set([wt for p in chunk for wt in wt_for_peptide.get(str(p), [])])
+            wt_peptides = [Peptide(seq) for seq in sorted(needed - scored_wt - chunk_sequences)]
+            scored_wt.update((chunk_sequences & wt_sequences) | needed)
+
+        chunk_by_length = defaultdict(list)
+        for p in chunk + wt_peptides:
+            chunk_by_length[len(p)].append(p)
+        results_by_length, skipped = predict_by_length(methods, chunk_by_length, alleles, set([str(p) for p in wt_peptides]))
+        skipped_predictions += skipped
+
+        # wild-types can differ in length from their mutated peptides, scores of all lengths are collected first
+        merged_by_length = {}
+        for peplen in sorted(results_by_length):
+            results = results_by_length[peplen]
+            if(len(results) == 0):
+                continue
+
+            df = results[0].merge_results(results[1:])
+
+            if predict_wt:
+                update_wt_score_lookup(wt_scores, df, wt_sequences)
+                df = df[np.array([str(idx[0]) in chunk_sequences for idx in df.index], dtype=bool)]
+            if not df.empty:
+                merged_by_length[peplen] = df
+
+        for peplen in sorted(merged_by_length):
+            df = merged_by_length[peplen]
+
+            for a in alleles:
+                conv_allele = "%s_%s%s" % (a.locus, a.supertype, a.subtype)
+                allele_string_map['%s_%s' % (a, peplen)] = '%s_%i' % (conv_allele, peplen)
+                max_values_matrices['%s_%i' % (conv_allele, peplen)] = get_matrix_max_score(conv_allele, peplen)
+
+            # rows are filtered before annotation
+            if OUTPUT_FILTER['mode'] != 'all':
+                df = filter_prediction_rows(df, peplen, max_values_matrices, allele_string_map, dropped, selector)
+                if df.empty:
+                    continue
+
+            # top-K rows are annotated once the heaps are final
+            if OUTPUT_FILTER['mode'] == 'topk':
+                top_k_rows[peplen].append(df)
+                continue
+
+            pred_dataframes.append(annotate_variant_predictions(df, peplen, methods, alleles, metadata, max_values_matrices, allele_string_map,
+                                                                wt_for_peptide if wild_type or predict_wt else None, wt_scores))
+
+        # rows evicted from the heaps are released after every chunk, at most the heaps and one chunk are held
+        if OUTPUT_FILTER['mode'] == 'topk':
+            top_k_rows = defaultdict(list, select_top_k_rows(top_k_rows, selector, dropped, max_values_matrices, allele_string_map))
+
+    for peplen in sorted(top_k_rows):
+        pred_dataframes.append(annotate_variant_predictions(top_k_rows[peplen][0], peplen, methods, alleles, metadata, max_values_matrices, allele_string_map,
+                                                            wt_for_peptide if wild_type or predict_wt else None, wt_scores))
+
+    statistics = {'date': datetime.now().strftime("%Y-%m-%d %H:%M:%S"), 'sample': identifier, 'alleles': '\n'.join([str(a) for a in alleles]),
+        'methods': '\n'.join(methods), 'variants': len(variants_all), 'peptides': counts['peptides'], 'filter': len(store),
+        'skipped': skipped_predictions, 'dropped_predictions': dropped}
+
+    return pred_dataframes, statistics
+
+
+def make_predictions_from_peptides(peptides, methods, alleles, protein_db, identifier, metadata):
+    # dictionaries for syfpeithi matrices max values and allele mapping
+    max_values_matrices = {}
+    allele_string_map = {}
+
+    # list to hold dataframes for all predictions
+    pred_dataframes = []
+
+    # number of predictions pruned in cascade mode
+    skipped_predictions = 0
+
+    # filter out self peptides if specified
+    selfies = [str(p) for p in peptides if protein_db.exists(str(p))]
+    peptides_filtered = [p for p in peptides if str(p) not in selfies]
+
+    # sort peptides by length (for predictions)
+    sorted_peptides = {}
+
+    for p in peptides_filtered:
+        length = len(str(p))
+        if length in sorted_peptides:
+            sorted_peptides[length].append(p)
+        else:
+            sorted_peptides[length] = [p]
+
+    # one invocation per method for all lengths
+    results_by_length, skipped_predictions = predict_by_length(methods, sorted_peptides, alleles)
+
+    for peplen in sorted(results_by_length):
+        results = results_by_length[peplen]
 
         # merge dataframes of the performed predictions
         if(len(results) == 0):
@@ -947,35 +3086,325 @@ def make_predictions_from_peptides(peptides, methods, alleles, protein_db, ident
                 df.insert(idx + 2, '%s binder' % c, df.apply(lambda x: create_binder_values(float(x['%s affinity' % c]), x['Method']), axis=1))
                 df = df.rename(columns={c: '%s score' % c})
 
+        if PERCENTILE_RANK['background'] is not None:
+            df = add_rank_columns(df, PERCENTILE_RANK['background'], methods, alleles, peplen)
+
         df = df.rename(columns={'Seq': 'sequence'})
         df = df.rename(columns={'Method': 'method'})
         pred_dataframes.append(df)
 
     # write prediction statistics
     statistics = {'date': str(datetime.now().strftime("%Y-%m-%d %H:%M:%S")), 'sample': identifier, 'alleles': '\n'.join([str(a) for a in alleles]), 'methods': '\n'.join(methods),
-    'variants': '-', 'peptides': len(peptides), 'filter': len(peptides_filtered), 'reference': '-'}
+    'variants': '-', 'peptides': len(peptides), 'filter': len(peptides_filtered), 'reference': '-', 'skipped': skipped_predictions}
+
+    return pred_dataframes, statistics
+
+
+def make_predictions_from_peptide_table(peptide_table, methods, alleles, protein_db, identifier, metadata):
+    """
+    predicts every unique sequence of a columnar peptide table once, the metadata columns are joined back
+    to the predictions per length instead of being stored on FRED2 peptides
+    """
+    max_values_matrices = {}
+    allele_string_map = {}
+    pred_dataframes = []
+
+    sequences = pd.Series(peptide_table['sequence'].unique())
+    sequences = sequences[~sequences.map(protein_db.exists).astype(bool)]
+    lengths = sequences.str.len()
+
+    mandatory_columns = ['chr', 'pos', 'gene', 'transcripts', 'proteins', 'variant type', 'synonymous', 'homozygous', 'variant details (genomic)', 'variant details (protein)']
+
+    # one invocation per method for all lengths
+    peptides_by_length = dict((peplen, [Peptide(seq) for seq in sequences[lengths == peplen]]) for peplen in lengths.unique())
+    results_by_length, skipped_predictions = predict_by_length(methods, peptides_by_length, alleles)
+    del peptides_by_length
+
+    for peplen in sorted(results_by_length):
+        results = results_by_length[peplen]
+        if(len(results) == 0):
+            continue
+        df = results[0].merge_results(results[1:])
+
+        for a in alleles:
+            conv_allele = "%s_%s%s" % (a.locus, a.supertype, a.subtype)
+            allele_string_map['%s_%s' % (a, peplen)] = '%s_%i' % (conv_allele, peplen)
+            max_values_matrices['%s_%i' % (conv_allele, peplen)] = get_matrix_max_score(conv_allele, peplen)
+
+        df.reset_index(inplace=True)
+        df['Seq'] = df['Seq'].map(str)
+        df.insert(2, 'length', peplen)
+
+        for c in df.columns:
+            if '*' in str(c):
+                idx = df.columns.get_loc(c)
+                df.insert(idx + 1, '%s affinity' % c, df.apply(lambda x: create_affinity_values(str(c), int(x['length']), float(x[c]), x['Method'], max_values_matrices, allele_string_map), axis=1))
+                df.insert(idx + 2, '%s binder' % c, df.apply(lambda x: create_binder_values(float(x['%s affinity' % c]), x['Method']), axis=1))
+                df = df.rename(columns={c: '%s score' % c})
+
+        if PERCENTILE_RANK['background'] is not None:
+            df = add_rank_columns(df, PERCENTILE_RANK['background'], methods, alleles, peplen)
+
+        df = df.rename(columns={'Seq': 'sequence'})
+        df = df.rename(columns={'Method': 'method'})
+
+        # join metadata side table, one output row per input row
+        df = df.merge(peptide_table, on='sequence', how='left')
+        for header in mandatory_columns:
+            if header not in df.columns:
+                df[header] = np.nan
+        pred_dataframes.append(df)
+
+    statistics = {'date': str(datetime.now().strftime("%Y-%m-%d %H:%M:%S")), 'sample': identifier, 'alleles': '\n'.join([str(a) for a in alleles]), 'methods': '\n'.join(methods),
+    'variants': '-', 'peptides': peptide_table.shape[0], 'filter': int(peptide_table['sequence'].isin(sequences).sum()), 'reference': '-', 'skipped': skipped_predictions}
 
     return pred_dataframes, statistics
 
 
+# per allele and method columns of the result tables, wild-type columns are only present with wild-type predictions,
+# %rank columns only with percentile ranks
+PREDICTION_VALUES = ['score', 'affinity', 'binder', 'wt score', 'wt affinity', 'mutant/wt ratio', '%rank']
+# wild-type values depend on the occurrence (variant and transcript of the mutated peptide), not only on its sequence
+WT_PREDICTION_VALUES = ['wt score', 'wt affinity', 'mutant/wt ratio']
+
+
+def get_allele_columns(columns):
+    # alleles with score columns in a result table
+    return [c[:-len(' score')] for c in columns if c.endswith(' score') and not c.endswith(' wt score')]
+
+
+# result files of variant shards and per-chromosome inputs are named <sample>.<shard>_prediction_results.tsv
+SAMPLE_PATTERN = r'^(.+?)(\.(?:chr|shard)[^._]+)?_prediction_results\.tsv$'
+
+
+def get_sample_name(filename, pattern=SAMPLE_PATTERN):
+    m = re.match(pattern, os.path.basename(filename))
+    return m.group(1) if m else os.path.basename(filename)
+
+
+def merge_results(shards, store_dir, sample_pattern, chunksize=200000):
+    """
+    streams prediction result shards into a deduplicated cohort store: one row per unique
+    (sequence, allele, method) prediction, an occurrence table linking sequences to samples and variants,
+    the (occurrence, method) rows of the shards, the wild-type values per occurrence, allele and method,
+    and the alleles per sample
+    :param shards: list of prediction result files
+    :param store_dir: output directory
+    :param sample_pattern: regular expression, first group of a file name match is the sample name
+    """
+    if not os.path.isdir(store_dir):
+        os.makedirs(store_dir)
+
+    # fixed occurrence columns are needed to append chunks of all shards to one file
+    occurrence_columns = ['sample']
+    prediction_shards = []
+    for shard in shards:
+        with open(shard, 'r') as inp:
+            header = inp.readline().rstrip('\n').split('\t')
+        if 'sequence' not in header or 'method' not in header:
+            logging.warning("{} is no prediction result file, skipped".format(shard))
+            continue
+        prediction_shards.append(shard)
+        allele_columns = set(['{} {}'.format(a, t) for a in get_allele_columns(header) for t in PREDICTION_VALUES])
+        occurrence_columns.extend([c for c in header if c not in allele_columns and c != 'method' and c not in occurrence_columns])
+
+    prediction_values = [t for t in PREDICTION_VALUES if t not in WT_PREDICTION_VALUES]
+    files = {'predictions': (os.path.join(store_dir, 'predictions.tsv'), ['sequence', 'allele', 'method'] + prediction_values),
+             'occurrences': (os.path.join(store_dir, 'occurrences.tsv'), ['occurrence'] + occurrence_columns),
+             'rows': (os.path.join(store_dir, 'rows.tsv'), ['occurrence', 'method']),
+             'wt_predictions': (os.path.join(store_dir, 'wt_predictions.tsv'), ['occurrence', 'allele', 'method'] + WT_PREDICTION_VALUES)}
+    for filename, columns in files.itervalues():
+        with open(filename, 'w') as out:
+            out.write('\t'.join(columns) + '\n')
+
+    # keys of the rows already written, every chunk is only compared against these
+    seen = dict((name, set()) for name in files)
+
+    def append_new(name, df, key_columns):
+        new = np.zeros(df.shape[0], dtype=bool)
+        for i, key in enumerate(zip(*[df[c].values for c in key_columns])):
+            if key not in seen[name]:
+                seen[name].add(key)
+                new[i] = True
+        df[new].reindex(columns=files[name][1]).to_csv(files[name][0], sep='\t', index=False, header=False, mode='a')
+        return int(new.sum())
+
+    sample_alleles = defaultdict(set)
+    n_predictions = 0
+    for shard in prediction_shards:
+        sample = get_sample_name(shard, sample_pattern)
+        for chunk in pd.read_csv(shard, sep='\t', dtype=str, chunksize=chunksize):
+            chunk['sample'] = sample
+            # the same peptide occurrence is listed once per method in the shards, its key is a hash of all occurrence columns
+            chunk['occurrence'] = chunk.reindex(columns=occurrence_columns).fillna('').apply(lambda row: hashlib.md5('\t'.join(row).encode('utf-8')).hexdigest(), axis=1)
+            append_new('occurrences', chunk, ['occurrence'])
+            # rows kept by the output filter of each sample, rows without any score included
+            append_new('rows', chunk, ['occurrence', 'method'])
+
+            for a in get_allele_columns(chunk.columns):
+                sub = chunk.reindex(columns=['occurrence', 'sequence', 'method'] + ['{} {}'.format(a, t) for t in PREDICTION_VALUES])
+                sample_alleles[sample].add(a)
+                sub.columns = ['occurrence', 'sequence', 'method'] + PREDICTION_VALUES
+                sub.insert(1, 'allele', a)
+                n_predictions += append_new('predictions', sub, ['sequence', 'allele', 'method'])
+                wt = sub.dropna(subset=WT_PREDICTION_VALUES, how='all')
+                if not wt.empty:
+                    append_new('wt_predictions', wt, ['occurrence', 'allele', 'method'])
+
+    with open(os.path.join(store_dir, 'samples.tsv'), 'w') as out:
+        out.write('sample\talleles\n')
+        for sample in sorted(sample_alleles):
+            out.write('{}\t{}\n'.format(sample, ','.join(sorted(sample_alleles[sample]))))
+    logging.info("Merged {} shards into {} unique predictions".format(len(prediction_shards), n_predictions))
+
+
+def rebuild_flat_results(store_dir, filename):
+    """
+    rebuilds the flat prediction result table (one row per occurrence and method) from a cohort store
+    """
+    occurrences = pd.read_csv(os.path.join(store_dir, 'occurrences.tsv'), sep='\t', dtype=str)
+    rows = pd.read_csv(os.path.join(store_dir, 'rows.tsv'), sep='\t', dtype=str)
+    predictions = pd.read_csv(os.path.join(store_dir, 'predictions.tsv'), sep='\t', dtype=str)
+    wt_predictions = pd.read_csv(os.path.join(store_dir, 'wt_predictions.tsv'), sep='\t', dtype=str)
+    samples = pd.read_csv(os.path.join(store_dir, 'samples.tsv'), sep='\t', dtype=str)
+
+    sample_alleles = pd.DataFrame([(r['sample'], a) for i, r in samples.iterrows() for a in str(r['alleles']).split(',')], columns=['sample', 'allele'])
+
+    # predictions of the rows of each sample for the alleles of the sample, wild-type values of the occurrence itself
+    long_df = rows.merge(occurrences[['occurrence', 'sample', 'sequence']], on='occurrence').merge(sample_alleles, on='sample')
+    long_df = long_df.merge(predictions, on=['sequence', 'allele', 'method']).merge(wt_predictions, on=['occurrence', 'allele', 'method'], how='left')
+    wide = long_df.pivot_table(index=['occurrence', 'method'], columns='allele', values=PREDICTION_VALUES, aggfunc='first', dropna=False)
+
+    alleles = sorted(sample_alleles['allele'].unique())
+    columns = [(t, a) for a in alleles for t in PREDICTION_VALUES if (t, a) in wide.columns and wide[(t, a)].notnull().any()]
+    wide = wide.reindex(columns=columns)
+    wide.columns = ['{} {}'.format(a, t) for t, a in columns]
+    wide.reset_index(inplace=True)
+
+    # rows are stored in the order of the shards, rows without any score are kept
+    flat = rows.merge(occurrences, on='occurrence', sort=False).merge(wide, on=['occurrence', 'method'], how='left', sort=False).drop('occurrence', axis=1)
+    leading_columns = [c for c in ['sample', 'sequence', 'length', 'chr', 'pos', 'gene', 'transcripts', 'proteins', 'variant type', 'method'] if c in flat.columns]
+    flat = flat.reindex(columns=leading_columns + [c for c in flat.columns if c not in leading_columns])
+    flat.to_csv(filename, sep='\t', index=False)
+
+
+def merge_variant_manifests(manifests, filename, sample_pattern):
+    """
+    merges the variant manifests of prediction shards into one manifest with a sample column, used as previous
+    manifest of incremental runs together with the rebuilt flat results
+    """
+    with open(filename, 'w') as out:
+        out.write('sample\ttranscript\tvariant\n')
+        for manifest_file in manifests:
+            sample = get_sample_name(manifest_file.replace('_variant_manifest.tsv', '_prediction_results.tsv'), sample_pattern)
+            manifest = read_variant_manifest(manifest_file)
+            for trans_id in sorted(manifest):
+                for signature in sorted(manifest[trans_id]):
+                    out.write('{}\t{}\t{}\n'.format(sample, trans_id, signature))
+
+
+def merge_main(argv):
+    parser = argparse.ArgumentParser(prog='epaa.py merge', description="Merges prediction result shards into a deduplicated cohort store and optionally rebuilds the flat result table.")
+    parser.add_argument('results', nargs='*', help="Prediction result files")
+    parser.add_argument('-s', "--store", default='cohort_store', help="Directory of the cohort store")
+    parser.add_argument("--sample_pattern", default=SAMPLE_PATTERN, help="Regular expression, the first group of a file name match is used as sample name")
+    parser.add_argument("--flat", help="Rebuild the flat result table from the store and write it to this file")
+    parser.add_argument("--manifest", help="Merge the variant manifests (*_variant_manifest.tsv) among the input files into this file")
+    args = parser.parse_args(argv)
+
+    manifests = [f for f in args.results if f.endswith('_variant_manifest.tsv')]
+    results = [f for f in args.results if f not in manifests]
+    if results:
+        merge_results(results, args.store, args.sample_pattern)
+    if args.manifest is not None:
+        merge_variant_manifests(manifests, args.manifest, args.sample_pattern)
+    if args.flat is not None:
+        rebuild_flat_results(args.store, args.flat)
+
+
+def parse_main(argv):
+    parser = argparse.ArgumentParser(prog='epaa.py parse', description="Parses a variant file once and writes binary variant shards grouped by transcript for the prediction step.")
+    parser.add_argument('variants', help="Variant file (VCF, GSvar or tsv)")
+    parser.add_argument('-n', "--shards", type=int, default=24, help="Maximal number of shards")
+    parser.add_argument('-o', "--prefix", help="Prefix of the shard files, default: name of the variant file without extension")
+    parser.add_argument('-g', "--germline_mutations", help="Germline variants, the germline delta of the self-filter is built once and written as <prefix>.germline_delta.tsv")
+    parser.add_argument('-c', "--mhcclass", default="I", help="MHC class I or II, determines the peptide lengths the shards are balanced by")
+    parser.add_argument('-r', "--reference", help="Reference, retrieved information will be based on this ensembl version", required=False, default='GRCh37', choices=['GRCh37', 'GRCh38'])
+    args = parser.parse_args(argv)
+
+    # the zygosity is stored as given, the prediction step limits the variant combinations per sample
+    if args.variants.endswith('.vcf') or args.variants.endswith('.vcf.gz'):
+        vl, transcripts = read_vcf(args.variants, limit_combinations=False)
+        metadata = []
+    else:
+        vl, transcripts, metadata = read_GSvar(args.variants, limit_combinations=False)
+
+    lengths = range(8, 12) if args.mhcclass == "I" else range(15, 17)
+    prefix = args.prefix or re.sub(r'\.(vcf|vcf\.gz|GSvar|tsv)$', '', os.path.basename(args.variants))
+    # an empty shard keeps the downstream steps running for inputs without coding variants
+    shards = group_variants_by_transcript(vl, args.shards, lengths[0], lengths[-1] + 1) or [[]]
+    for i, shard in enumerate(shards):
+        write_variant_shard(shard, metadata, '{}.shard{}.epv'.format(prefix, i))
+    logging.info("Wrote {} variants into {} shards".format(len(vl), len(shards)))
+
+    if args.germline_mutations is not None:
+        added, removed, altered = build_germline_delta(args.germline_mutations, MartsAdapter(biomart=REFERENCES[args.reference]), lengths)
+        write_germline_delta(added, removed, altered, '{}.germline_delta.tsv'.format(prefix))
+
+
 def __main__():
+    if len(sys.argv) > 1 and sys.argv[1] == 'merge':
+        merge_main(sys.argv[2:])
+        return
+    if len(sys.argv) > 1 and sys.argv[1] == 'parse':
+        parse_main(sys.argv[2:])
+        return
+
     parser = argparse.ArgumentParser(description="""EPAA 1.0 \n Pipeline for prediction of MHC class I and II epitopes from variants or peptides for a list of specified alleles. 
         Additionally predicted epitopes can be annotated with protein quantification values for the corresponding proteins, identified ligands, or differential expression values for the corresponding transcripts.""", version=VERSION)
-    parser.add_argument('-s', "--somatic_mutations", help='Somatic variants')
+    parser.add_argument('-s', "--somatic_mutations", help='Somatic variants (VCF, GSvar, tsv or variant shard written by epaa.py parse)')
     parser.add_argument('-g', "--germline_mutations", help="Germline variants")
+    parser.add_argument("--germline_delta", help="Germline delta of the self-filter written by epaa.py parse, instead of --germline_mutations", required=False)
     parser.add_argument('-p', "--peptides", help="File with one peptide per line")
+    parser.add_argument("--columnar_peptides", help="Read peptide input chunk-wise into a columnar table, for very large peptide lists", required=False, action='store_true')
     parser.add_argument('-c', "--mhcclass", default="I", help="MHC class I or II")
     parser.add_argument('-l', "--length", help="Maximum peptide length")
     parser.add_argument('-a', "--alleles", help="<Required> MHC Alleles", required=True)
     parser.add_argument('-r', "--reference", help="Reference, retrieved information will be based on this ensembl version", required=False, default='GRCh37', choices=['GRCh37', 'GRCh38'])
     parser.add_argument('-f', "--filter_self", help="Filter peptides against human proteom", required=False, action='store_true')
     parser.add_argument('-wt', "--wild_type", help="Add wild type sequences of mutated peptides to output", required=False, action='store_true')
-    parser.add_argument('-rp', "--reference_proteome", help="Reference proteome for self-filtering", required=False)
-    parser.add_argument('-gr', "--gene_reference", help="List of gene IDs for ID mapping.", required=False)
+    parser.add_argument('-rp', "--reference_proteome", help="Reference proteome(s) for self-filtering, comma separated list of FASTA files or directories", required=False)
+    parser.add_argument("--proteome_cache", help="Directory of the parsed reference proteome caches (Bloom filters and background scores are stored next to them), default: working directory", required=False)
+    parser.add_argument('-gr', "--gene_reference", help="Gene index (.npy) or list of gene IDs for ID mapping, an index is built for a list", required=False)
     parser.add_argument('-pq', "--protein_quantification", help="File with protein quantification values")
     parser.add_argument('-ge', "--gene_expression", help="File with differential expression analysis results (DESeq2 Output)")
     parser.add_argument('-li', "--ligandomics_id", help="Comma separated file with peptide sequence, score and median intensity of a ligandomics identification run.")
     parser.add_argument('-o', "--output_dir", help="All files written will be put in this directory")
+    parser.add_argument('-i', "--identifier", help="Prefix of all files written, default: name of the input file without extension")
+    parser.add_argument('-t', "--threads", type=int, default=1, help="Number of concurrent external predictor processes")
+    parser.add_argument("--predictor_timeout", type=int, default=1800, help="Timeout in seconds per chunk of peptides for external predictors")
+    parser.add_argument("--predictor_retries", type=int, default=1, help="Number of retries per chunk of peptides for external predictors")
+    parser.add_argument("--wild_type_predictions", help="Predict wild-type sequences of mutated peptides together with the mutated ones and add wild-type scores and mutant/wild-type ratios", required=False, action='store_true')
+    parser.add_argument("--cascade", help="Predict only peptides passing the Syfpeithi prefilter with the other methods", required=False, action='store_true')
+    parser.add_argument("--cascade_threshold", type=float, default=0.25, help="Prefilter threshold as fraction of the max Syfpeithi score of an allele, used if no threshold is configured and the calibration sample contains no binders")
+    parser.add_argument("--cascade_thresholds", help="Tab separated prefilter thresholds per allele (columns allele, threshold, optional length), other alleles are calibrated", required=False)
+    parser.add_argument("--cascade_recall", type=float, default=0.99, help="Fraction of binders of the calibration sample kept by calibrated prefilter cutoffs")
+    parser.add_argument("--previous_results", help="Prediction results of a previous run of the same sample, only predictions for changed transcripts will be updated", required=False)
+    parser.add_argument("--previous_manifest", help="Variant manifest of the previous run, required together with --previous_results", required=False)
+    parser.add_argument("--min_tumor_af", type=float, help="Minimal tumor allele frequency of variants (GSvar)", required=False)
+    parser.add_argument("--min_tumor_dp", type=int, help="Minimal tumor read depth of variants (GSvar)", required=False)
+    parser.add_argument("--min_rna_af", type=float, help="Minimal tumor RNA allele frequency of variants (GSvar)", required=False)
+    parser.add_argument("--min_rna_dp", type=int, help="Minimal tumor RNA read depth of variants (GSvar)", required=False)
+    parser.add_argument("--min_expression", type=float, help="Minimal expression (RPKM) of genes in the HTSeq counts of --gene_expression, variants in genes below are dropped", required=False)
+    parser.add_argument("--output_mode", default='all', choices=['all', 'threshold', 'topk'], help="Write all predictions, only predictions passing the thresholds, or the top-K predictions per group (variant input)")
+    parser.add_argument("--affinity_threshold", type=float, default=500.0, help="Maximal affinity (IC50 in nM) of netMHC predictions in threshold mode")
+    parser.add_argument("--syfpeithi_threshold", type=float, default=50.0, help="Minimal Syfpeithi score (percent of the max score of the allele) in threshold mode")
+    parser.add_argument("--top_k", type=int, default=10, help="Number of predictions kept per group and method in top-K mode")
+    parser.add_argument("--top_k_by", default='allele', choices=['variant', 'allele', 'sample'], help="Groups of the top-K mode")
+    parser.add_argument("--percentile_rank", help="Add %%rank columns against cached background score distributions of random peptides of the (first) reference proteome", required=False, action='store_true')
+    parser.add_argument("--background_size", type=int, default=10000, help="Number of random background peptides per length for percentile ranks")
+    parser.add_argument("--max_memory", type=int, help="Memory budget in MB, peptide chunk sizes and number of external predictor processes are chosen to fit into it", required=False)
+    parser.add_argument("--plan_only", help="Only write the resource estimate of the predictions and exit", required=False, action='store_true')
 
     args = parser.parse_args()
 
@@ -983,12 +3412,27 @@ def __main__():
         parser.print_help()
         sys.exit(1)
 
-    with open(args.somatic_mutations.replace('.vcf', '.tsv').replace('.GSvar', '.tsv'), 'w') as out:
-        out.write('id\n')
-        out.write(args.somatic_mutations)
+    if args.somatic_mutations is None and args.peptides is None:
+        parser.error("Please specify variants (--somatic_mutations) or peptides (--peptides).")
 
+    if (args.previous_results is None) != (args.previous_manifest is None):
+        parser.error("Incremental mode requires both --previous_results and --previous_manifest.")
+
+    if args.min_expression is not None:
+        if args.gene_expression is None or 'HTSeq' not in args.gene_expression:
+            parser.error("Expression pruning (--min_expression) requires HTSeq counts (--gene_expression), differential expression results hold no RPKM values.")
+        if args.gene_reference is None:
+            parser.error("Expression pruning (--min_expression) requires the gene lengths of the gene index (--gene_reference).")
+
+    if args.percentile_rank and args.reference_proteome is None:
+        parser.error("Percentile ranks (--percentile_rank) require a reference proteome (--reference_proteome).")
+
+    if args.columnar_peptides and (args.wild_type or args.wild_type_predictions):
+        parser.error("Wild-type sequences (--wild_type, --wild_type_predictions) are not available for columnar peptide input (--columnar_peptides).")
+
+    if args.identifier is None:
+        args.identifier = re.sub(r'\.(vcf|vcf\.gz|GSvar|tsv|epv)$', '', os.path.basename(args.somatic_mutations or args.peptides))
 
-    """
     if args.output_dir is not None:
         try:
             os.chdir(args.output_dir)
@@ -1006,53 +3450,141 @@ def __main__():
 
     '''start the actual IRMA functions'''
     metadata = []
-    references = {'GRCh37': 'http://feb2014.archive.ensembl.org', 'GRCh38': 'http://dec2016.archive.ensembl.org'}
     global transcriptProteinMap
     global transcriptSwissProtMap
 
+    # peptide lengths of the variant predictions and the self-filter
+    lengths = range(8, 12) if args.mhcclass == "I" else range(15, 17)
+
     '''read in variants or peptides'''
-    if args.peptides:
+    pruning = {'pruned_frequency': '-', 'pruned_expression': '-'}
+    if args.peptides and args.columnar_peptides:
+        peptide_table, metadata = read_peptide_table(args.peptides)
+    elif args.peptides:
         peptides, metadata = read_peptide_input(args.peptides)
     else:
-        if args.somatic_mutations.endswith('.GSvar') or args.somatic_mutations.endswith('.tsv'):
+        if args.somatic_mutations.endswith('.epv'):
+            vl, transcripts, metadata = read_variant_shard(args.somatic_mutations)
+            vl = limit_variant_combinations(vl, list(set(metadata + ['vardbid'])))
+        elif args.somatic_mutations.endswith('.GSvar') or args.somatic_mutations.endswith('.tsv'):
             vl, transcripts, metadata = read_GSvar(args.somatic_mutations)
         elif args.somatic_mutations.endswith('.vcf'):
             vl, transcripts = read_vcf(args.somatic_mutations)
 
+        # prune variants before any lookups and predictions
+        vl, pruning['pruned_frequency'] = prune_variants_by_frequency(vl, {'tumor_af': args.min_tumor_af, 'tumor_dp': args.min_tumor_dp,
+                                                                           'rna_tum_freq': args.min_rna_af, 'rna_tum_depth': args.min_rna_dp})
+        if args.min_expression is not None:
+            gene_index = load_gene_index(args.gene_reference)
+            vl, pruning['pruned_expression'] = prune_variants_by_expression(vl, read_gene_expression(args.gene_expression, gene_index), args.min_expression, gene_index)
+        remaining_transcripts = set([t for v in vl for t in v.coding.iterkeys()])
+        transcripts = [t for t in transcripts if t in remaining_transcripts]
+
+        # write manifest of the variants left after pruning, used for incremental re-predictions
+        manifest = create_variant_manifest(vl, metadata)
+        write_variant_manifest(manifest, '{}_variant_manifest.tsv'.format(args.identifier))
+
+        # incremental mode, restrict predictions to transcripts with changed variants
+        if args.previous_results is not None:
+            # previous results and manifest merged by 'epaa.py merge' list all samples, transcripts of other shards of
+            # this sample are affected as they are not in the manifest of the shard and their rows are dropped
+            sample = get_sample_name('{}_prediction_results.tsv'.format(args.identifier))
+            previous_df = pd.read_csv(args.previous_results, sep='\t')
+            if 'sample' in previous_df.columns:
+                previous_df = previous_df[previous_df['sample'].map(str) == sample].drop('sample', axis=1)
+            affected_transcripts = get_affected_transcripts(read_variant_manifest(args.previous_manifest, sample), manifest)
+            affected_transcripts = expand_affected_transcripts(previous_df, affected_transcripts)
+            logging.info("Incremental mode: {} transcripts affected by changed variants".format(len(affected_transcripts)))
+
+            # nothing changed, the previous results are still valid and no lookups or predictions are needed
+            if not affected_transcripts:
+                previous_df.to_csv("{}_prediction_results.tsv".format(args.identifier), '\t', index=False)
+                statistics = {'date': str(datetime.now().strftime("%Y-%m-%d %H:%M:%S")), 'sample': args.identifier,
+                              'alleles': '\n'.join([str(a) for a in FileReader.read_lines(args.alleles, in_type=Allele)]),
+                              'methods': '\n'.join(['netmhc-4.0', 'syfpeithi-1.0', 'netmhcpan-3.0'] if args.mhcclass == "I" else ['netmhcII-2.2', 'syfpeithi-1.0', 'netmhcIIpan-3.1']),
+                              'variants': len(vl), 'peptides': 0, 'filter': 0, 'skipped': 0, 'reference': args.reference}
+                statistics.update(compute_prediction_statistics(previous_df))
+                statistics.update(pruning)
+                with open('{}_prediction_statistics.txt'.format(args.identifier), 'w') as stats:
+                    stats.write(write_prediction_report(statistics))
+                logging.info("Incremental mode: no transcripts affected, previous results kept")
+                return
+
+            vl = restrict_variants_to_transcripts(vl, affected_transcripts, list(set(metadata + ['vardbid'])))
+            transcripts = [t for t in transcripts if t in affected_transcripts]
+
+        # plan chunk sizes and external predictor processes before the expensive lookups
+        n_alleles = len(FileReader.read_lines(args.alleles, in_type=Allele))
+        # the transcript list has one entry per annotation, variants are counted once per affected transcript
+        n_transcript_variants = len(set([(v.chrom, v.genomePos, v.ref, v.obs, t) for v in vl for t in v.coding]))
+        plan = plan_resources(estimate_variant_peptides(n_transcript_variants, lengths[0], lengths[-1] + 1), len(set(transcripts)), n_alleles,
+                              ['netmhc-4.0', 'syfpeithi-1.0', 'netmhcpan-3.0'] if args.mhcclass == "I" else ['netmhcII-2.2', 'syfpeithi-1.0', 'netmhcIIpan-3.1'],
+                              args.max_memory, args.threads)
+        write_resource_estimate(plan, '{}_resource_estimate.json'.format(args.identifier))
+        logging.info("Resource estimate: {memory_mb} MB, {runtime_s} s, {threads} threads, chunk size {chunk_size}".format(**plan))
+        if args.plan_only:
+            return
+        RESOURCE_PLAN['chunk_size'] = plan['chunk_size']
+        args.threads = plan['threads']
+
         transcripts = list(set(transcripts))
-        transcriptProteinMap, transcriptSwissProtMap = get_protein_ids_for_transcripts(ID_SYSTEM_USED, transcripts, references[args.reference], args.reference)
+        transcriptProteinMap, transcriptSwissProtMap = get_protein_ids_for_transcripts(ID_SYSTEM_USED, transcripts, REFERENCES[args.reference], args.reference)
+
+    EXTERNAL_RUNNER['threads'] = args.threads
+    EXTERNAL_RUNNER['timeout'] = args.predictor_timeout
+    EXTERNAL_RUNNER['retries'] = args.predictor_retries
+    CASCADE['enabled'] = args.cascade
+    CASCADE['threshold'] = args.cascade_threshold
+    CASCADE['recall'] = args.cascade_recall
+    if args.cascade_thresholds is not None:
+        CASCADE['thresholds'] = read_cascade_thresholds(args.cascade_thresholds)
+    OUTPUT_FILTER['mode'] = args.output_mode
+    OUTPUT_FILTER['affinity_threshold'] = args.affinity_threshold
+    OUTPUT_FILTER['syfpeithi_threshold'] = args.syfpeithi_threshold
+    OUTPUT_FILTER['k'] = args.top_k
+    OUTPUT_FILTER['by'] = args.top_k_by
 
     # get the alleles
     alleles = FileReader.read_lines(args.alleles, in_type=Allele)
 
     # initialize MartsAdapter, GRCh37 or GRCh38 based
-    ma = MartsAdapter(biomart=references[args.reference])
+    ma = MartsAdapter(biomart=REFERENCES[args.reference])
 
     # create protein db instance for filtering self-peptides
     up_db = UniProtDB('sp')
     if args.filter_self:
         logging.info('Reading human proteome')
+        up_db = load_tiered_proteomes(args.reference_proteome.split(','), lengths, args.threads, cache_dir=args.proteome_cache)
 
-        if os.path.isdir(args.reference_proteome):
-            for filename in os.listdir(args.reference_proteome):
-                if filename.endswith(".fasta") or filename.endswith(".fsa"): 
-                    up_db.read_seqs(os.path.join(args.reference_proteome, filename))
+    # personalize the self-filter with the germline variants of the patient
+    if args.filter_self and (args.germline_delta is not None or args.germline_mutations is not None):
+        if args.germline_delta is not None:
+            delta = read_germline_delta(args.germline_delta)
         else:
-            up_db.read_seqs(args.reference_proteome)
+            delta = build_germline_delta(args.germline_mutations, ma, lengths)
+        up_db = PersonalizedProteinDB(up_db, *delta)
+
+    # background score distributions of the percentile ranks, cached next to the (first) reference proteome cache
+    if args.percentile_rank:
+        PERCENTILE_RANK['background'] = BackgroundScores(load_reference_proteome(args.reference_proteome.split(',')[0], args.threads, args.proteome_cache), args.background_size)
 
     # MHC class I or II predictions
     if args.mhcclass == "I":
         methods = ['netmhc-4.0', 'syfpeithi-1.0', 'netmhcpan-3.0']
-        if args.peptides:
+        if args.peptides and args.columnar_peptides:
+            pred_dataframes, statistics = make_predictions_from_peptide_table(peptide_table, methods, alleles, up_db, args.identifier, metadata)
+        elif args.peptides:
             pred_dataframes, statistics = make_predictions_from_peptides(peptides, methods, alleles, up_db, args.identifier, metadata)
         else:
-            pred_dataframes, statistics, all_peptides_filtered = make_predictions_from_variants(vl, methods, alleles, 8, 12, ma, up_db, args.identifier, metadata, transcriptProteinMap)
+            pred_dataframes, statistics = make_predictions_from_variants(vl, methods, alleles, 8, 12, ma, up_db, args.identifier, metadata, transcriptProteinMap, args.wild_type, args.wild_type_predictions)
     else:
         methods = ['netmhcII-2.2', 'syfpeithi-1.0', 'netmhcIIpan-3.1']
-        if args.peptides:
+        if args.peptides and args.columnar_peptides:
+            pred_dataframes, statistics = make_predictions_from_peptide_table(peptide_table, methods, alleles, up_db, args.identifier, metadata)
+        elif args.peptides:
             pred_dataframes, statistics = make_predictions_from_peptides(peptides, methods, alleles, up_db, args.identifier, metadata)
         else:
-            pred_dataframes, statistics, all_peptides_filtered = make_predictions_from_variants(vl, methods, alleles, 15, 17, ma, up_db, args.identifier, metadata, transcriptProteinMap)
+            pred_dataframes, statistics = make_predictions_from_variants(vl, methods, alleles, 15, 17, ma, up_db, args.identifier, metadata, transcriptProteinMap, args.wild_type, args.wild_type_predictions)
 
     # concat dataframes for all peptide lengths
     try:
@@ -1068,11 +3600,16 @@ def __main__():
 
     # replace method names with method names with version
     complete_df.replace({'method': method_map}, inplace=True)
+    dropped = statistics.pop('dropped_predictions', None)
+    if dropped is not None:
+        dropped.rename_methods(method_map)
 
     # include wild type sequences to dataframe if specified
-    if args.wild_type:
-        wt_sequences = generate_wt_seqs(all_peptides_filtered)
-        complete_df['wt sequence'] = complete_df.apply(lambda row: create_wt_seq_column_value(row, wt_sequences), axis=1)
+    if args.wild_type or args.wild_type_predictions:
+        if 'wt sequence' not in complete_df.columns:
+            # wild-types are only reconstructed for the rows written
+            wt_reconstructor = WildTypeReconstructor()
+            complete_df['wt sequence'] = complete_df.apply(lambda row: create_wt_seq_column_value(row, wt_reconstructor), axis=1)
         columns_tiles = ['sequence', 'wt sequence', 'length', 'chr', 'pos', 'gene', 'transcripts', 'proteins', 'variant type', 'method']
     # Change the order (the index) of the columns
     else:
@@ -1082,27 +3619,6 @@ def __main__():
             columns_tiles.append(c)
     complete_df = complete_df.reindex(columns=columns_tiles)
 
-    binder_cols = [col for col in complete_df.columns if 'binder' in col]
-
-    binders = []
-    non_binders = []
-    pos_predictions = []
-    neg_predictions = []
-
-    for i, r in complete_df.iterrows():
-        binder = False
-        for c in binder_cols:
-            if r[c] is True:
-                binder = True
-                continue
-        if binder:
-            binders.append(str(r['sequence']))
-            pos_predictions.append(str(r['sequence']))
-        else:
-            neg_predictions.append(str(r['sequence']))
-            if str(r['sequence']) not in binders:
-                non_binders.append(str(r['sequence']))
-    
     # parse protein quantification results, annotate proteins for samples
     if args.protein_quantification is not None:
         protein_quant = read_protein_quant(args.protein_quantification)
@@ -1111,27 +3627,23 @@ def __main__():
             complete_df['{} log2 protein LFQ intensity'.format(k)] = complete_df.apply(lambda row: create_quant_column_value_for_result(row, protein_quant, transcriptSwissProtMap, k), axis=1)
         
     # parse differential expression analysis results (DESe2), annotate features (genes/transcripts)
-    if args.differential_expression is not None:
-        fold_changes = read_diff_expression_values(args.differential_expression)
-        gene_id_lengths = {}
+    if args.gene_expression is not None:
+        fold_changes = read_diff_expression_values(args.gene_expression)
+        gene_index = load_gene_index(args.gene_reference) if args.gene_reference is not None else None
+        # id systems of the gene column and of the expression features are resolved once per run
+        feature_map = map_genes_to_features(complete_df['gene'], gene_index, resolve_gene_id_system(fold_changes.keys()))
+        total_counts = 0.0
         deseq = False
 
-        if 'HTSeq' in args.differential_expression:
+        if 'HTSeq' in args.gene_expression:
             col_name = 'RNA expression (RPKM)'
-            with open(args.gene_reference, 'r') as gene_list:
-                for l in gene_list:
-                    ids = l.split('\t')
-                    gene_id_in_df = complete_df.iloc[1]['gene']
-                    #if ID_SYSTEM_USED == EIdentifierTypes.ENSEMBL:
-                    if 'ENSG' in gene_id_in_df:
-                        gene_id_lengths[ids[0]] = float(ids[2].strip())
-                    else:
-                        gene_id_lengths[ids[1]] = float(ids[2].strip())
+            # N counts the reads of the genes with known length, without a gene index all gene features count
+            total_counts = sum([float(v) for k, v in fold_changes.iteritems() if not k.startswith('__') and (gene_index is None or gene_index.length(k) is not None)])
         else:
             col_name = 'RNA normal_vs_tumor.log2FoldChange'
             deseq = True
         # add column to result dataframe
-        complete_df[col_name] = complete_df.apply(lambda row: create_expression_column_value_for_result(row, fold_changes, deseq, gene_id_lengths), axis=1)
+        complete_df[col_name] = complete_df.apply(lambda row: create_expression_column_value_for_result(row, fold_changes, deseq, gene_index, feature_map, total_counts), axis=1)
 
     # parse ligandomics identification results, annotate peptides for samples
     if args.ligandomics_id is not None:
@@ -1144,15 +3656,16 @@ def __main__():
             complete_df['wt ligand score'] = complete_df.apply(lambda row: create_ligandomics_column_value_for_result(row, lig_id, 0, True), axis=1)
             complete_df['wt ligand intensity'] = complete_df.apply(lambda row: create_ligandomics_column_value_for_result(row, lig_id, 1, True), axis=1)
 
+    # incremental mode, replace predictions of affected transcripts in previous results
+    if args.previous_results is not None and args.somatic_mutations is not None:
+        complete_df = patch_prediction_results(previous_df, complete_df, affected_transcripts, metadata)
+
     # write dataframe to tsv
     complete_df.fillna('')
     complete_df.to_csv("{}_prediction_results.tsv".format(args.identifier), '\t', index=False)
 
-    statistics['predictions'] = complete_df.shape[0]
-    statistics['binders'] = len(pos_predictions)
-    statistics['nonbinders'] = len(neg_predictions)
-    statistics['uniquebinders'] = len(set(binders))
-    statistics['uniquenonbinders'] = len(set(non_binders) - set(binders))
+    statistics.update(compute_prediction_statistics(complete_df, dropped))
+    statistics.update(pruning)
 
     if 'reference' not in statistics:
         statistics['reference'] = args.reference
@@ -1160,7 +3673,6 @@ def __main__():
     with open('{}_prediction_statistics.txt'.format(args.identifier), 'w') as stats:
         stats.write(write_prediction_report(statistics))
     logging.info("Finished predictions at " + str(datetime.now().strftime("%Y-%m-%d %H:%M:%S")))
-    """
 
 if __name__ == "__main__":
     __main__()
\ No newline at end of file
@@ -35,15 +35,32 @@ def helpMessage() {
     Options:
       --filter_self                 Specifies that peptides should be filtered against the specified human proteome references Default: false
       --wild_type                   Specifies that wild-type sequences of mutated peptides should be predicted as well Default: false
+      --wild_type_predictions       Specifies that wild-type peptides are predicted together with the mutated ones, adding wild-type scores and mutant/wild-type ratios Default: false
+      --cascade                     Specifies that only peptides passing a Syfpeithi prefilter are predicted with the other methods Default: false
+      --cascade_thresholds          Path to TSV file with prefilter thresholds per allele (allele, threshold, optional length), other alleles are calibrated Default: false
       --mhc_class                   Specifies whether the predictions should be done for MHC class I or class II. Default: 1
       --peptide_length              Specifies the maximum peptide length Default: MHC class I: 11, MHC class II: 16 
+      --variant_shards              Specifies the maximal number of variant shards (grouped by transcript) predicted in parallel Default: 24
+      --min_tumor_af                Specifies the minimal tumor allele frequency of variants (GSvar input) Default: false
+      --min_tumor_dp                Specifies the minimal tumor read depth of variants (GSvar input) Default: false
+      --min_rna_af                  Specifies the minimal tumor RNA allele frequency of variants (GSvar input) Default: false
+      --min_rna_dp                  Specifies the minimal tumor RNA read depth of variants (GSvar input) Default: false
+      --min_expression              Specifies the minimal expression (RPKM) of genes in the HTSeq counts of --gene_expression, variants in genes below are dropped Default: false
+      --output_mode                 Specifies whether all predictions ('all'), only predictions passing the binder thresholds ('threshold') or the top-K predictions per group ('topk') are written Default: all
+      --top_k                       Specifies the number of predictions kept per group and method in top-K mode Default: 10
+      --top_k_by                    Specifies the groups of the top-K mode (variant, allele, sample) Default: allele
+      --percentile_rank             Specifies that %rank columns against cached background score distributions of random reference proteome peptides are added Default: false
+      --previous_results            Path to the merged prediction results of a previous run (merged_prediction_results.tsv), only predictions of transcripts with changed variants are updated Default: false
+      --previous_manifest           Path to the merged variant manifest of the previous run (merged_variant_manifest.tsv), required together with --previous_results Default: false
 
     References                      If not specified in the configuration file or you wish to overwrite any of the references
       --reference_genome            Specifies the ensembl reference genome version (GRCh37, GRCh38) Default: GRCh37
-      --reference_proteome          Specifies the reference proteome(s) used for self-filtering
+      --reference_proteome          Specifies the reference proteome(s) used for self-filtering (comma separated list of Fastas or directories)
+      --proteome_cache              Specifies the directory of parsed reference proteome caches of a previous run (published to <outdir>/proteome_cache), the reference is parsed again otherwise Default: false
 
     Additional inputs:
       --reference_proteome          Path to reference proteome Fastas
+      --germline_mutations          Path to germline variants, used to personalize the reference proteome for self-filtering
       --protein_quantification      Path to protein quantification file (MaxQuant) for additional annotation
       --gene_expression             Path to gene expression file for additional annotation
       --ligandomics_identification  Path to ligandomics identification file for additional annotation
@@ -81,14 +98,31 @@ params.plaintext_email = false
 
 params.filter_self = false
 params.wild_type = false
+params.wild_type_predictions = false
+params.cascade = false
+params.cascade_thresholds = false
 params.mhc_class = 'I'
 params.reference_genome = 'GRCh37'
 params.peptide_length = (params.mhc_class == 'I') ? 11 : 16
+params.variant_shards = 24
+params.min_tumor_af = false
+params.min_tumor_dp = false
+params.min_rna_af = false
+params.min_rna_dp = false
+params.min_expression = false
+params.output_mode = 'all'
+params.top_k = 10
+params.top_k_by = 'allele'
+params.percentile_rank = false
+params.previous_results = false
+params.previous_manifest = false
 
 params.protein_quantification = false
 params.gene_expression = false
 params.ligandomics_identification = false
 params.reference_proteome = false
+params.proteome_cache = false
+params.germline_mutations = false
 
 multiqc_config = file(params.multiqc_config)
 output_docs = file("$baseDir/docs/output.md")
@@ -96,8 +130,8 @@ output_docs = file("$baseDir/docs/output.md")
 ch_split_peptides = Channel.empty()
 ch_split_variants = Channel.empty()
 
-// List of coding genes for Ensembl ID to HGNC mapping
-gene_list = file("$baseDir/assets/all_coding_genes_GRCh_ensembl_hgnc.tsv")
+// Index of coding genes (Ensembl ID, HGNC symbol, length) for ID mapping, built from all_coding_genes_GRCh_ensembl_hgnc.tsv
+gene_list = file("$baseDir/assets/all_coding_genes_GRCh_ensembl_hgnc.npy")
 
 // Validate inputs and create channels for input data
 // if ( !params.somatic_mutations.toBoolean() ^ params.peptides.toBoolean() ) exit 1, "Please specify a peptide OR variant file."
@@ -135,6 +169,37 @@ if ( params.filter_self & !params.reference_proteome ){
     params.reference_proteome = file("$baseDir/assets/")
 }
 
+// background peptides are sampled from the reference proteome and their scores are cached with the proteome caches
+if ( params.percentile_rank & !params.reference_proteome ){
+    exit 1, "Percentile ranks (--percentile_rank) require a reference proteome (--reference_proteome)."
+}
+
+// parsed reference proteome caches (sequence blob, index, Bloom filters, background scores) are written to the task
+// work directories, caches of a previous run are staged into the prediction tasks
+if ( params.proteome_cache ) {
+    Channel
+        .fromPath("${params.proteome_cache}/epaa_proteome_*")
+        .collect()
+        .ifEmpty([])
+        .set { ch_proteome_cache_in }
+}
+else {
+    ch_proteome_cache_in = Channel.value([])
+}
+
+// expression pruning normalizes HTSeq counts, differential expression results hold log2 fold changes
+if ( params.min_expression & !(params.gene_expression && params.gene_expression.toString().contains('HTSeq')) ){
+    exit 1, "Expression pruning (--min_expression) requires HTSeq counts (--gene_expression)."
+}
+
+// incremental runs diff the variants against the manifest of the previous run
+if ( !params.previous_results != !params.previous_manifest ){
+    exit 1, "Incremental mode requires both --previous_results and --previous_manifest."
+}
+if ( params.previous_results && params.peptides ){
+    exit 1, "Incremental mode (--previous_results, --previous_manifest) is only available for variant inputs."
+}
+
 // AWSBatch sanity checking
 if(workflow.profile == 'awsbatch'){
     if (!params.awsqueue || !params.awsregion) exit 1, "Specify correct --awsqueue and --awsregion parameters on AWSBatch!"
@@ -177,14 +242,29 @@ summary['Run Name']     = custom_runName ?: workflow.runName
 if ( params.somatic_mutations ) summary['Variants'] = params.somatic_mutations
 if ( params.peptides ) summary['Peptides'] = params.peptides
 if ( params.reference_proteome ) summary['Reference proteome'] = params.reference_proteome
+if ( params.proteome_cache ) summary['Proteome cache'] = params.proteome_cache
+if ( params.germline_mutations ) summary['Germline variants'] = params.germline_mutations
 if ( params.protein_quantification ) summary['Protein Quantification'] = params.protein_quantification
 if ( params.gene_expression ) summary['Gene Expression'] = params.gene_expression
 if ( params.ligandomics_identification ) summary['Ligandomics Identification'] = params.ligandomics_identification
+if ( params.min_tumor_af ) summary['Min. Tumor AF'] = params.min_tumor_af
+if ( params.min_tumor_dp ) summary['Min. Tumor Depth'] = params.min_tumor_dp
+if ( params.min_rna_af ) summary['Min. RNA AF'] = params.min_rna_af
+if ( params.min_rna_dp ) summary['Min. RNA Depth'] = params.min_rna_dp
+if ( params.min_expression ) summary['Min. Expression'] = params.min_expression
+summary['Output Mode'] = params.output_mode
+summary['Percentile Ranks'] = params.percentile_rank
+if ( params.previous_results ) summary['Previous Results'] = params.previous_results
+if ( params.previous_manifest ) summary['Previous Manifest'] = params.previous_manifest
 summary['Genome Version'] = params.reference_genome
 summary['MHC Class'] = params.mhc_class
 summary['Max. Peptide Length'] = params.peptide_length
+summary['Variant Shards'] = params.variant_shards
 summary['Self-Filter'] = params.filter_self
 summary['Wild-types'] = params.wild_type
+summary['Wild-type Predictions'] = params.wild_type_predictions
+summary['Cascade'] = params.cascade
+summary['Cascade Thresholds'] = params.cascade_thresholds
 summary['Max Memory']   = params.max_memory
 summary['Max CPUs']     = params.max_cpus
 summary['Max Time']     = params.max_time
@@ -245,7 +325,7 @@ process get_software_versions {
 
 
 /*
- * STEP 1 - Split variant data
+ * STEP 1 - Parse variant data once into binary shards grouped by transcript
  */
 process splitVariants {
     input:
@@ -254,22 +334,14 @@ process splitVariants {
     when: !params.peptides
 
     output:
-    file '*chr*.vcf' optional true into ch_splitted_vcfs
-    file '*chr*.tsv' optional true into ch_splitted_tsvs
-    file '*chr*.GSvar' optional true into ch_splitted_gsvars
+    file '*.epv' into ch_variant_shards
+    file '*.germline_delta.tsv' optional true into ch_germline_delta
 
     script:
-    if ( variants.toString().endsWith('.vcf') || variants.toString().endsWith('.vcf.gz') ) {
-        """
-        SnpSift split ${variants}
-        """
-    }
-    else {
-         """
-        sed -i.bak '/^##/d' ${variants}
-        csvtk split ${variants} -t -C '&' -f '#chr'
-        """
-    }
+    def gl = params.germline_mutations ? "--germline_mutations ${params.germline_mutations} --reference ${params.reference_genome}" : ""
+    """
+    epaa.py parse ${variants} --shards ${params.variant_shards} --mhcclass ${params.mhc_class} ${gl}
+    """
 }
 
 /*
@@ -292,47 +364,113 @@ process splitPeptides {
 
 
 /*
- * STEP 2 - Run epitope prediction
+ * STEP 2 - Estimate resources of the epitope prediction
+ */
+process estimateResources {
+    input:
+    file inputs from ch_variant_shards.flatten()
+    file alleles from allele_file
+
+    output:
+    set file(inputs), file("*_resource_estimate.json") into ch_resource_estimates
+
+    script:
+    def max_memory = (params.max_memory as nextflow.util.MemoryUnit).toMega()
+    def ge = params.gene_expression ? "--gene_expression ${params.gene_expression}" : ""
+    def pruning = ['min_tumor_af', 'min_tumor_dp', 'min_rna_af', 'min_rna_dp', 'min_expression'].findAll { params[it] != false }.collect { "--${it} ${params[it]}" }.join(' ')
+    """
+    epaa.py --somatic_mutations ${inputs} --identifier ${inputs.baseName} --alleles ${params.alleles} --mhcclass ${params.mhc_class} --gene_reference ${gene_list} --threads ${params.max_cpus} --max_memory ${max_memory} ${ge} ${pruning} --plan_only
+    """
+}
+
+// request the estimated memory and cpus up front, peptide inputs keep the defaults
+ch_resource_estimates
+    .map { inputs, estimate -> def plan = new groovy.json.JsonSlurper().parseText(estimate.text); [inputs, plan.memory_mb, plan.threads] }
+    .mix(ch_splitted_peptides.flatten().map { [it, 8192, 1] })
+    .set { ch_prediction_inputs }
+
+/*
+ * STEP 3 - Run epitope prediction
  */
 process peptidePrediction {
+    cpus { check_max( threads * task.attempt, 'cpus' ) }
+    memory { check_max( (memory_mb as long).MB * task.attempt, 'memory' ) }
+
     input:
-    file inputs from ch_splitted_vcfs.flatten().mix(ch_splitted_tsvs.flatten(), ch_splitted_gsvars.flatten(), ch_splitted_peptides.flatten())
+    set file(inputs), val(memory_mb), val(threads) from ch_prediction_inputs
     file alleles from allele_file
+    file germline_delta from ch_germline_delta.collect().ifEmpty([])
+    file proteome_cache from ch_proteome_cache_in
 
     output:
-    file "*.tsv" into ch_predicted_peptides
+    file "*_prediction_results.tsv" into ch_predicted_peptides
+    file "*_prediction_statistics.txt"
+    file "*_variant_manifest.tsv" optional true into ch_variant_manifests
+    file "epaa_proteome_*" optional true into ch_proteome_cache
    
    script:
    def input_type = params.peptides ? "--peptides ${inputs}" : "--somatic_mutations ${inputs}"
    def ref_prot = params.reference_proteome ? "--reference_proteome ${params.reference_proteome}" : ""
+   // the germline delta is built once by the parse step, peptide inputs build it themselves
+   def gl = !params.germline_mutations ? "" : params.peptides ? "--germline_mutations ${params.germline_mutations}" : "--germline_delta ${germline_delta}"
    def wt = params.wild_type ? "--wild_type" : ""
+   def wtp = params.wild_type_predictions ? "--wild_type_predictions" : ""
+   def fs = params.filter_self ? "--filter_self" : ""
+   def cascade = params.cascade ? "--cascade" : ""
+   def ct = params.cascade_thresholds ? "--cascade_thresholds ${params.cascade_thresholds}" : ""
+   def rank = params.percentile_rank ? "--percentile_rank" : ""
    def qt = params.protein_quantification ? "--protein_quantification ${params.protein_quantification}" : ""
    def ge = params.gene_expression ? "--gene_expression ${params.gene_expression}" : ""
-   def li = params.ligandomics_identification ? "--ligandomics_identification ${params.ligandomics_identification}" : ""
+   def li = params.ligandomics_identification ? "--ligandomics_id ${params.ligandomics_identification}" : ""
+   def pruning = ['min_tumor_af', 'min_tumor_dp', 'min_rna_af', 'min_rna_dp', 'min_expression'].findAll { params[it] != false }.collect { "--${it} ${params[it]}" }.join(' ')
+   def incremental = params.previous_results ? "--previous_results ${params.previous_results} --previous_manifest ${params.previous_manifest}" : ""
    """
-   epaa.py ${input_type} --alleles ${params.alleles} --mhcclass ${params.mhc_class} --length ${params.peptide_length} --reference ${params.reference_genome} --gene_reference ${gene_list} ${ref_prot} ${qt} ${ge} ${li} ${wt}
+   epaa.py ${input_type} --identifier ${inputs.baseName} --alleles ${params.alleles} --mhcclass ${params.mhc_class} --length ${params.peptide_length} --reference ${params.reference_genome} --gene_reference ${gene_list} --threads ${task.cpus} --max_memory ${task.memory.toMega()} ${fs} ${ref_prot} ${gl} ${qt} ${ge} ${li} ${wt} ${wtp} ${cascade} ${ct} ${rank} ${pruning} --output_mode ${params.output_mode} --top_k ${params.top_k} --top_k_by ${params.top_k_by} ${incremental}
    """
 }
 
 /*
- * STEP 3 - Combine epitope prediction results
+ * Publish the reference proteome caches written by the prediction tasks, once per cache file
+ */
+process publishProteomeCache {
+    publishDir "${params.outdir}/proteome_cache", mode: 'copy'
+
+    input:
+    file caches from ch_proteome_cache.flatten().unique { it.name }.collect()
+
+    output:
+    file caches
+
+    script:
+    """
+    ls -l ${caches}
+    """
+}
+
+/*
+ * STEP 4 - Combine epitope prediction results
  */
 process mergeResults {
+    publishDir "${params.outdir}", mode: 'copy'
+
     input:
     file predictions from ch_predicted_peptides.collect()
+    file manifests from ch_variant_manifests.collect().ifEmpty([])
 
     output:
     file 'merged_prediction_results.tsv'
+    file 'merged_variant_manifest.tsv'
+    file 'cohort_store'
 
     script:
     """
-    csvtk concat -t $predictions > merged_prediction_results.tsv
+    epaa.py merge --store cohort_store --flat merged_prediction_results.tsv --manifest merged_variant_manifest.tsv $predictions $manifests
     """
 }
 
 
 /*
- * STEP 4 - MultiQC
+ * STEP 5 - MultiQC
  */
 process multiqc {
     publishDir "${params.outdir}/MultiQC", mode: 'copy'
@@ -358,7 +496,7 @@ process multiqc {
 
 
 /*
- * STEP 5 - Output Description HTML
+ * STEP 6 - Output Description HTML
  */
 process output_documentation {
     tag "$prefix"